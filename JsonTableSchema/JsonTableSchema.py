@@ -15,6 +15,7 @@
 # This programme is free software; you may redistribute and/or modify
 # it under the terms of the Apache Software Licence v2.0
 
+import os
 import json
 import sys
 import csvdatatypes
@@ -37,6 +38,7 @@ class JSONTableSchema(object):
       # Initialise JSONTableSchema object, optionally from a JSON string
       
       self.fields = []
+      self.field_index = {}      # field name to field descriptor
       self.format_version = self.__format_version__
       
       if json_string is not None:
@@ -85,7 +87,7 @@ class JSONTableSchema(object):
       for key in self.required_field_descriptor_keys:      
          if not isinstance(field[key], (str, unicode)):
             raise FormatError("Field `name' must be a string")
-         if field["name"] in self.field_names:
+         if field["name"] in self.field_index:
             raise DuplicateFieldName("field 'name'")
          field_dict[key] = field[key]
       
@@ -99,14 +101,22 @@ class JSONTableSchema(object):
                
             field_dict[key] = field[key]
       
-      #TODO: Complex types, format and constraints
+      if "constraints" in field:
+         field_dict["constraints"] = self.check_constraints(field["constraints"], field["name"])
+
+      #TODO: Complex types and format
     
       self.fields.append(field_dict)
+      self.field_index[field_dict["name"]] = field_dict
+
+   def get_field(self, field_name):
+      return self.field_index[field_name]
 
    def remove_field(self, field_name):
-      if field_name not in self.field_names:
+      if field_name not in self.field_index:
          raise KeyError
       self.fields = filter(lambda i: i["name"] != field_name, self.fields)
+      del self.field_index[field_name]
 
    def as_json(self):
       return json.dumps(self.as_dict(), indent=2)
@@ -128,16 +138,34 @@ class JSONTableSchema(object):
          csv_header = csv_header + '"' + str(name) + '",'
       return csv_header[:-1]
 
+   def check_constraints(self, constraints, field_name):
+      if not isinstance(constraints, dict):
+         raise FormatError("Field `constraints' for `%s' must be a hash" % field_name)
+      for key in constraints:
+         if key not in self.optional_constraints_keys:
+            err_tmpl = "Invalid constraint `%s' in field descriptor for `%s'" % (key, field_name)
+            raise FormatError(err_tmpl)
+      return dict(constraints)
+
    def check_type(self, field_type, field_name):
   
-      type_found = False
-      for field_category in csvdatatypes.__valid_type_names__:
-         for type in field_category:
-            if field_type == type:
-               type_found = True
-               break
-      
-      if type_found != True:
+      if field_type not in csvdatatypes.__valid_type_set__:
          err_tmpl = "Invalid type `%s' in field descriptor for `%s'" % (field_type, field_name)
          raise FormatError(err_tmpl)
-         
\ No newline at end of file
+
+
+# Schemas already read, by path, so every component of a run shares one
+# parsed schema. An entry is read again if the file has changed since.
+# The schema returned is shared and should not be modified.
+__schema_cache__ = {}
+
+def load_schema(path):
+   path = os.path.abspath(path)
+   stat = os.stat(path)
+   stamp = (stat.st_size, stat.st_mtime)
+   cached = __schema_cache__.get(path)
+   if cached is None or cached[0] != stamp:
+      with open(path, 'rb') as f:
+         cached = (stamp, JSONTableSchema(f.read()))
+      __schema_cache__[path] = cached
+   return cached[1]
@@ -33,4 +33,7 @@ __valid_type_names__ = [
    ["geojson"],                                                                                                         # as per <<http://http://geojson.org/>>
    ["array", "http://www.elasticsearch.org/guide/en/elasticsearch/reference/current/mapping-array-type.html"],          # an array
    ["any", "http://www.w3.org/2001/XMLSchema#anyURI"]                                                                   # value of field may be any type
-]
\ No newline at end of file
+]
+
+# Every valid type name, for checking a field's type in one lookup
+__valid_type_set__ = set(type for category in __valid_type_names__ for type in category)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Generate synthetic DROID reports, and matching external CSVs, for the
+# benchmark suite. Output is deterministic for a given seed.
+#
+# Usage: python benchmarks/generatedata.py --rows 100000 --hash md5
+#
+import os
+import sys
+import csv
+import random
+import hashlib
+import argparse
+import ConfigParser
+
+droidheader = ["ID", "PARENT_ID", "URI", "FILE_PATH", "NAME", "METHOD",
+               "STATUS", "SIZE", "TYPE", "EXT", "LAST_MODIFIED",
+               "EXTENSION_MISMATCH", "HASH", "FORMAT_COUNT", "PUID",
+               "MIME_TYPE", "FORMAT_NAME", "FORMAT_VERSION"]
+
+externalheader = ["FILE_PATH", "MD5 Hash", "Author", "Control Number",
+                  "File Name", "Unified Title", "Created Date",
+                  "Last Modified Date", "Unitization Identifier",
+                  "Family Group", "Has Native", "Custodian"]
+
+hashcolumns = {'md5': 'MD5_HASH', 'sha1': 'SHA1_HASH',
+               'sha256': 'SHA256_HASH'}
+
+extensions = [("docx", "fmt/412", "Microsoft Word for Windows"),
+              ("pdf", "fmt/276", "Acrobat PDF 1.7"),
+              ("xlsx", "fmt/214", "Microsoft Excel for Windows"),
+              ("msg", "x-fmt/430", "Microsoft Outlook Email Message"),
+              ("jpg", "fmt/43", "JPEG File Interchange Format")]
+
+words = ["Annual", "Report", "Minutes", "Budget", "Draft", "Final",
+         "Correspondence", "Policy", "Review", u"Māori", "Plan", "Notes"]
+
+filesperfolder = 20
+containereverynth = 25   # one zip in every n files carries contents
+matchrate = 0.9          # fraction of files described by the external CSV
+
+
+def pathmask(configfile):
+    config = ConfigParser.RawConfigParser()
+    config.read(configfile)
+    # the first mask, where several are given
+    return config.get('additional values', 'pathmask').strip().splitlines()[0]
+
+
+def encode(row):
+    return [v.encode('utf-8') if isinstance(v, unicode) else v for v in row]
+
+
+def generate(rows, hashtype, outdir, configfile, seed=1):
+    rand = random.Random(seed)
+    root = pathmask(configfile).rstrip('\\')
+    header = list(droidheader)
+    header[12] = hashcolumns[hashtype]
+
+    droidname = os.path.join(outdir, "droid-%d-%s.csv" % (rows, hashtype))
+    extname = os.path.join(outdir, "external-%d-%s.csv" % (rows, hashtype))
+
+    with open(droidname, 'wb') as droidfile, open(extname, 'wb') as extfile:
+        droid = csv.writer(droidfile, quoting=csv.QUOTE_ALL)
+        external = csv.writer(extfile)
+        droid.writerow(header)
+        external.writerow(externalheader)
+
+        id = 0
+        folder = None
+        folderid = 0
+        while id < rows:
+            # a new folder every so often, nested at most three deep
+            if id % (filesperfolder + 1) == 0:
+                depth = rand.randint(1, 3)
+                folder = root + "\\" + "\\".join(
+                    "%s %d" % (rand.choice(words), rand.randint(1, 999))
+                    for _ in range(depth))
+                id += 1
+                folderid = id
+                droid.writerow(encode([
+                    id, "", "file:/" + folder.replace("\\", "/") + "/",
+                    folder, folder.rsplit("\\", 1)[1], "", "Done", "",
+                    "Folder", "", "2016-03-04T05:06:07", "false", "", "",
+                    "", "", "", ""]))
+                continue
+
+            id += 1
+            ext, puid, formatname = rand.choice(extensions)
+            name = u"%s %s %d.%s" % (rand.choice(words), rand.choice(words),
+                                     id, ext)
+            path = folder + "\\" + name
+            digest = hashlib.new(hashtype, path.encode('utf-8')).hexdigest()
+            modified = "%04d-%02d-%02dT%02d:%02d:%02d" % (
+                rand.randint(1995, 2020), rand.randint(1, 12),
+                rand.randint(1, 28), rand.randint(0, 23),
+                rand.randint(0, 59), rand.randint(0, 59))
+            uri = "file:/" + path.replace("\\", "/")
+            droid.writerow(encode([
+                id, folderid, uri, path, name, "Signature", "Done",
+                rand.randint(1, 10 ** 7), "File", ext, modified, "false",
+                digest, "1", puid, "", formatname, ""]))
+
+            # container contents, which the import sheet skips
+            if id % containereverynth == 0 and id < rows:
+                id += 1
+                inner = "inner %d.txt" % id
+                droid.writerow(encode([
+                    id, id - 1, "zip:" + uri + "!/" + inner,
+                    path + "!" + inner, inner, "Extension", "Done", "10",
+                    "File", "txt", modified, "false",
+                    hashlib.new(hashtype, inner).hexdigest(), "1",
+                    "x-fmt/111", "", "Plain Text File", ""]))
+
+            if rand.random() < matchrate:
+                created = "%d/%02d/%04d" % (rand.randint(1, 28),
+                                            rand.randint(1, 12),
+                                            rand.randint(1995, 2020))
+                external.writerow(encode([
+                    path.replace(root, ""), digest.upper(),
+                    "Author %d" % rand.randint(1, 50), "C%d" % id,
+                    name, u"%s %s" % (rand.choice(words), rand.choice(words)),
+                    created, modified[:4], "U%d" % id, "", "yes", "Agency"]))
+
+    return droidname, extname
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic DROID and external CSVs for benchmarking.')
+    parser.add_argument(
+        '--rows', help='DROID rows to generate.', type=int, nargs='+',
+        default=[10000, 100000, 1000000])
+    parser.add_argument(
+        '--hash', help='Checksum algorithm DROID reported.',
+        choices=sorted(hashcolumns), default='md5')
+    parser.add_argument(
+        '--out', help='Directory to write to.', default='benchmarks/data')
+    parser.add_argument(
+        '--config', help='Mapping config providing the path mask.',
+        default='config/import-mapping.cfg')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    for rows in args.rows:
+        droidname, extname = generate(
+            rows, args.hash, args.out, args.config, args.seed)
+        sys.stderr.write("Wrote " + droidname + " and " + extname + "\n")
+
+if __name__ == "__main__":
+    main()
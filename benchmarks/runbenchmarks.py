@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+#
+# Time each stage of import sheet generation over synthetic data made by
+# generatedata.py, and record the results as JSON so runs can be compared.
+#
+# Usage: python benchmarks/runbenchmarks.py --rows 10000 100000
+#            [--hash md5|sha1|sha256] [--workers N] [--columnar]
+#            [--format csv|jsonl|binary]
+#            [--results results.json] [--compare previous.json]
+#
+# Each size runs in its own process so that peak RSS is measured per size.
+#
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+from datetime import datetime
+
+repodir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+configfile = "config/import-mapping.cfg"
+jsonschema = "schema/archway-import-schema.json"
+
+# stages are reported in this order, any others after them
+stagenames = ["read (unicodecsv)", "read", "filter", "external load",
+              "external match", "map", "write"]
+
+
+# Wraps a generator stage and accumulates the time spent in its next()
+class TimedStage:
+
+    def __init__(self, iterable):
+        self.iterable = iter(iterable)
+        self.seconds = 0.0
+        self.rowsout = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            row = self.iterable.next()
+        finally:
+            self.seconds += time.time() - start
+        self.rowsout += 1
+        return row
+
+
+def stage(seconds, rowsin, rowsout):
+    rate = 0
+    if seconds > 0:
+        rate = int(rowsin / seconds)
+    return {"seconds": round(seconds, 4), "rows_in": rowsin,
+            "rows_out": rowsout, "rows_per_sec": rate}
+
+
+# The shipped config maps the MD5 checksum; reports with another checksum
+# get a copy mapping theirs instead, kept with the data.
+def hashconfig(hashtype, datadir):
+    if hashtype == 'md5':
+        return configfile
+    import ConfigParser
+    config = ConfigParser.RawConfigParser()
+    config.read(configfile)
+    column = hashtype.upper() + "_HASH"
+    for name, value in config.items('droid mapping'):
+        if value == 'MD5_HASH':
+            config.set('droid mapping', name, column)
+    hashconfigfile = os.path.join(datadir, "import-mapping-%s.cfg" % hashtype)
+    with open(hashconfigfile, 'wb') as f:
+        config.write(f)
+    return hashconfigfile
+
+
+# One run of the generator as import-generator.py makes it, timed by the
+# generator's own PipelineStats.
+def runsingle(rows, hashtype, datadir, external, workers=1,
+              columnar=False, format="csv"):
+    sys.path.insert(0, os.path.join(repodir, "libs"))
+    import unicodecsv
+    from droidcsvhandlerclass import CSVRowReader
+    from ImportSheetGenerator import ImportSheetGenerator
+    from ExternalCSVHandlerClass import ExternalCSVHandler
+    from PipelineStats import PipelineStats
+
+    droidcsv = os.path.join(datadir, "droid-%d-%s.csv" % (rows, hashtype))
+    extcsv = os.path.join(datadir, "external-%d-%s.csv" % (rows, hashtype))
+    config = hashconfig(hashtype, datadir)
+
+    stats = PipelineStats()
+    generator = ImportSheetGenerator(droidcsv, jsonschema, config)
+    generator.setStats(stats)
+    generator.setWorkers(workers)
+    generator.setColumnar(columnar)
+    generator.setFormat(format)
+
+    # the per-cell decoding reader the DROID pipeline used to use, reading
+    # the same columns, for comparison with the 'read' stage
+    stages = {}
+    positions = CSVRowReader(droidcsv, generator.droidcolumns()).positions
+    with open(droidcsv, 'rb') as csvfile:
+        reader = unicodecsv.reader(csvfile)
+        reader.next()
+        baseline = TimedStage(tuple([row[p] for p in positions])
+                              for row in reader)
+        for row in baseline:
+            pass
+    stages["read (unicodecsv)"] = stage(baseline.seconds, baseline.rowsout,
+                                        baseline.rowsout)
+
+    start = time.time()
+    if external:
+        handler = ExternalCSVHandler(config, jsonschema)
+        handler.setStats(stats)
+        with stats.stage("external load"):
+            generator.setExternalCSV(handler.readExternalCSV(extcsv))
+    devnull = open(os.devnull, 'wb')
+    generator.setOutfile(devnull)
+    generator.droid2archwayimport()
+    devnull.close()
+    total = time.time() - start
+
+    # stages a row passes through are rated by rows in, the rest, e.g.
+    # loading the external CSV, by the DROID rows read
+    rowsread = generator.droidcsvhandler.rowcount
+    for name, timing in stats.stages.items():
+        rowsin = timing["rows_in"] or rowsread
+        stages[name] = stage(timing["seconds"], rowsin, timing["rows_out"])
+    if "write" in stages:
+        stages["write"]["bytes"] = stats.counters.get("bytes written", 0)
+
+    return {
+        "rows": rows,
+        "hash": hashtype,
+        "external": external,
+        "workers": workers,
+        "columnar": columnar,
+        "format": format,
+        "stages": stages,
+        "counters": stats.counters,
+        "total_seconds": round(total, 4),
+        "rows_per_sec": int(rowsread / total) if total > 0 else 0,
+        # ru_maxrss is in kilobytes on Linux, bytes on OS X; workers count
+        # as children
+        "peak_rss_kb": max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+    }
+
+
+def runall(args):
+    results = []
+    for rows in args.rows:
+        droidcsv = os.path.join(args.data, "droid-%d-%s.csv"
+                                % (rows, args.hash))
+        if not os.path.isfile(droidcsv):
+            subprocess.check_call([
+                sys.executable, os.path.join("benchmarks", "generatedata.py"),
+                "--rows", str(rows), "--hash", args.hash, "--out", args.data])
+        command = [sys.executable, os.path.abspath(__file__), "--single",
+                   "--rows", str(rows), "--hash", args.hash,
+                   "--data", args.data]
+        if args.no_ext:
+            command.append("--no-ext")
+        if args.columnar:
+            command.append("--columnar")
+        command.extend(["--workers", str(args.workers),
+                        "--format", args.format])
+        sys.stderr.write("Benchmarking %d rows...\n" % rows)
+        results.append(json.loads(subprocess.check_output(command)))
+    return {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+# Results are only compared with a previous result of the same variant,
+# results written before workers, columnar and format were recorded were
+# run with the defaults
+def variantkey(result):
+    return (result["rows"], result["hash"], result["external"],
+            result.get("workers", 1), result.get("columnar", False),
+            result.get("format", "csv"))
+
+
+def report(run, previous=None):
+    before = {}
+    if previous is not None:
+        for result in previous["results"]:
+            before[variantkey(result)] = result
+    for result in run["results"]:
+        old = before.get(variantkey(result))
+        variant = "%s, %d workers, %s" % (result["hash"],
+                                          result.get("workers", 1),
+                                          result.get("format", "csv"))
+        if result.get("columnar"):
+            variant += ", columnar"
+        sys.stdout.write("%d rows (%s): %.2fs, %d rows/sec, peak RSS %d KB\n"
+                         % (result["rows"], variant,
+                            result["total_seconds"], result["rows_per_sec"],
+                            result["peak_rss_kb"]))
+        names = stagenames + sorted(set(result["stages"]) - set(stagenames))
+        for name in names:
+            if name not in result["stages"]:
+                continue
+            rate = result["stages"][name]["rows_per_sec"]
+            line = "    %-32s %12d rows/sec" % (name, rate)
+            if old is not None and name in old["stages"]:
+                oldrate = old["stages"][name]["rows_per_sec"]
+                if oldrate > 0:
+                    line += "  (x%.2f)" % (float(rate) / oldrate)
+            sys.stdout.write(line + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark import sheet generation stage by stage.')
+    parser.add_argument(
+        '--rows', help='DROID report sizes to benchmark.', type=int,
+        nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument(
+        '--hash', help='Checksum algorithm in the DROID report.',
+        choices=['md5', 'sha1', 'sha256'], default='md5')
+    parser.add_argument(
+        '--data', help='Directory of generated data.',
+        default=os.path.join(repodir, 'benchmarks', 'data'))
+    parser.add_argument(
+        '--no-ext', help='Benchmark without an external CSV.',
+        default=False, action='store_true')
+    parser.add_argument(
+        '--workers', help='Processes to map the import sheet with.',
+        type=int, default=1)
+    parser.add_argument(
+        '--columnar', help='Map in blocks of rows, a column at a time.',
+        default=False, action='store_true')
+    parser.add_argument(
+        '--format', help='Import sheet format to write.',
+        choices=['csv', 'jsonl', 'binary'], default='csv')
+    parser.add_argument(
+        '--results', help='JSON file to write results to.',
+        default=os.path.join(repodir, 'benchmarks', 'results.json'))
+    parser.add_argument(
+        '--compare', help='Previous results JSON to compare against.',
+        default=None)
+    parser.add_argument('--single', help=argparse.SUPPRESS,
+                        default=False, action='store_true')
+    args = parser.parse_args()
+
+    # the libraries expect paths relative to the repository
+    args.data = os.path.abspath(args.data)
+    args.results = os.path.abspath(args.results)
+    if args.compare is not None:
+        args.compare = os.path.abspath(args.compare)
+    os.chdir(repodir)
+
+    if args.single:
+        json.dump(runsingle(args.rows[0], args.hash, args.data,
+                            not args.no_ext, args.workers, args.columnar,
+                            args.format), sys.stdout)
+        return
+
+    run = runall(args)
+    with open(args.results, 'wb') as results:
+        json.dump(run, results, indent=2, sort_keys=True)
+    previous = None
+    if args.compare is not None:
+        with open(args.compare, 'rb') as compare:
+            previous = json.load(compare)
+    report(run, previous)
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,116 @@
 ﻿# -*- coding: utf-8 -*-
 import sys
+import os.path
 import argparse
 from libs.ImportOverviewGenerator import ImportOverviewGenerator
 from libs.ImportSheetGenerator import ImportSheetGenerator
+from libs.ImportSheetWriter import CSVSheetWriter
 from libs.ExternalCSVHandlerClass import ExternalCSVHandler
+from libs.BatchRunner import BatchRunner
+from libs.ExternalCache import ExternalCache
+from libs.PreviousRun import PreviousRun, runrecord, writerunrecord
+from libs.PipelineStats import PipelineStats
+from libs.SheetValidator import schemavalidator
+from libs.OutputFile import OutputFile
+from libs.FileHasher import FileHasher
 
 
-def handleExternalCSV(csv, importGenerator, configfile, importschema):
+def handleExternalCSV(csv, importGenerator, configfile, importschema,
+                      stats=None, cachedir=None, matchlog=None):
     ex = ExternalCSVHandler(configfile, importschema)
-    externalCSV = ex.readExternalCSV(csv)
+    ex.setStats(stats)
+    if cachedir:
+        ex.setCache(ExternalCache(cachedir))
+    with importGenerator.stats.stage("external load"):
+        externalCSV = ex.readExternalCSV(csv)
+    if matchlog is not None:
+        externalCSV.setMatchLog(matchlog)
     importGenerator.setExternalCSV(externalCSV)
     return
 
 
-def createImportOverview(droidcsv, configfile):
+# How each DROID row was matched to the external CSV, one row per file
+def createMatchLog(logfile):
+    matchlog = CSVSheetWriter(logfile)
+    matchlog.writeheader(["FILE_PATH", "CHECKSUM", "MATCH"])
+    return matchlog
+
+
+def createImportOverview(droidcsv, configfile, outfile=None):
     createoverview = ImportOverviewGenerator(droidcsv, configfile)
-    createoverview.createOverviewSheet()
+    createoverview.createOverviewSheet(outfile)
+
+
+# Write the overview from the folders collected while the import sheet was
+# generated, so the DROID CSV is only read once for both.
+def createCombinedOverview(importgenerator, configfile, overviewfile):
+    createoverview = ImportOverviewGenerator(False, configfile)
+    createoverview.setFolderList(importgenerator.droidcsvhandler.folders)
+    with outputFile(overviewfile) as outfile:
+        createoverview.outputOverview(outfile)
+
+
+# Sheets are written to a temp file that is renamed to the path once it is
+# complete, or to stdout if no path is given. Set in main from --buffer-size
+# and --gzip.
+outputbuffer = None
+outputgzip = None
 
 
-def importsheetDROIDmapping(droidcsv, importschema, configfile):
+def outputFile(path):
+    return OutputFile(path or None, outputbuffer, outputgzip)
+
+
+def importsheetDROIDmapping(droidcsv, importschema, configfile, workers=1,
+                            stats=None, previouscsv=None, previoussheet=None,
+                            columnar=False, validator=None, format="csv",
+                            hasher=None, record=None):
     importgenerator = ImportSheetGenerator(droidcsv, importschema, configfile)
+    importgenerator.setFormat(format)
+    importgenerator.setHasher(hasher)
+    importgenerator.setValidator(validator)
+    importgenerator.setWorkers(workers)
+    importgenerator.setColumnar(columnar)
+    importgenerator.setStats(stats)
+    if previouscsv and previoussheet:
+        importgenerator.setPrevious(PreviousRun(previouscsv, previoussheet,
+                                                record))
     return importgenerator
 
 
-def createImportCSV(importgenerator):
-    importgenerator.droid2archwayimport()
+# With a path, a record of the run is written alongside the sheet so a later
+# run can reuse its rows with --prevsheet.
+def createImportCSV(importgenerator, outfile=None, record=None):
+    with outputFile(outfile) as f:
+        importgenerator.setOutfile(f, outputbuffer)
+        importgenerator.droid2archwayimport()
+    if outfile and record is not None:
+        writerunrecord(outfile, record)
+
+
+# Returns the number of schema violations found in the sheet
+def validateImportCSV(sheet, importschema, workers=1):
+    validator = schemavalidator(importschema)
+    violations = validator.validatesheet(sheet, workers)
+    validator.report()
+    return violations
+
+
+# Returns False if any accession failed
+def createBatchImportCSVs(accessions, outdir, importschema, configfile,
+                          workers=1, columnar=False, cachedir=None):
+    runner = BatchRunner(importschema, configfile, outdir, workers)
+    runner.setColumnar(columnar)
+    if cachedir:
+        runner.setCache(ExternalCache(cachedir))
+    try:
+        accessions = runner.readaccessions(accessions)
+    except (ValueError, IOError) as e:
+        sys.stderr.write("Unable to read accessions: " + str(e) + "\n")
+        return False
+    summary = runner.runall(accessions)
+    runner.report(summary)
+    return summary["failed"] == 0
 
 
 def main():
@@ -38,44 +124,200 @@ def main():
         description='Generate Archway Import Sheet and Rosetta Ingest CSV from DROID CSV Reports.')
 
     parser.add_argument(
-        '--csv', help='Single DROID CSV to read.', default=False, required=True)
+        '--csv', help='Single DROID CSV to read.', default=False, required=False)
+    parser.add_argument(
+        '--accessions', help='Directory or manifest of DROID CSVs, each with an optional external CSV, to write import sheets for.',
+                        default=False, required=False)
+    parser.add_argument(
+        '--outdir', help='Directory to write import sheets and a summary to with --accessions.',
+                        default='.', required=False)
+    parser.add_argument(
+        '--out', '--output', help='File to write the import sheet or overview to instead of stdout. It only appears once complete.',
+                        default=False, required=False)
+    parser.add_argument(
+        '--buffer-size', help='Bytes to buffer between writes to the output.',
+                        default=None, required=False, type=int)
+    parser.add_argument(
+        '--gzip', help='Gzip compress the output, the default for an --out or --overfile ending in .gz.',
+                        default=None, required=False, action="store_true")
     parser.add_argument(
         '--over', '--overview', help='Create an import overview sheet.',
                         default=False, required=False, action="store_true")
+    parser.add_argument(
+        '--overfile', '--overview-file', help='With an import sheet, also write the overview sheet to this file from the same read of the DROID CSV.',
+                        default=False, required=False)
     parser.add_argument(
         '--ext', '--external', help='Insert data from an arbitrary CSV.', default=False, required=False)
+    parser.add_argument(
+        '--match-log', help='With --ext, write how each file was matched (exact, checksum, path, miss or ambiguous) to this CSV.',
+                        default=False, required=False)
+    parser.add_argument(
+        '--ext-cache', help='Directory to cache parsed external CSV metadata in between runs.',
+                        default=False, required=False)
+    parser.add_argument(
+        '--prevcsv', '--previous-csv', help='DROID CSV an earlier import sheet was generated from.',
+                        default=False, required=False)
+    parser.add_argument(
+        '--prevsheet', '--previous-sheet', help='Earlier import sheet, written with --out, to reuse rows from for files unchanged since --prevcsv.',
+                        default=False, required=False)
+    parser.add_argument(
+        '--hash-files', help='Compute checksums missing from the DROID CSV by reading the files it lists.',
+                        default=False, required=False, action="store_true")
+    parser.add_argument(
+        '--hash-algorithm', help='Checksum to compute with --hash-files, by default the one the DROID CSV has a column for, or MD5.',
+                        default=None, required=False, choices=['md5', 'sha1', 'sha256'])
+    parser.add_argument(
+        '--hash-threads', help='Threads to read files with for --hash-files.',
+                        default=None, required=False, type=int)
+    parser.add_argument(
+        '--hash-cache', help='File to keep checksums computed with --hash-files in between runs, by path, size and modification time.',
+                        default=False, required=False)
+    parser.add_argument(
+        '--workers', help='Number of processes to map the import sheet with, or with --accessions, to process accessions with.',
+                        default=1, required=False, type=int)
+    parser.add_argument(
+        '--format', help='Import sheet format: quoted CSV, JSON Lines, or the compact binary format read by ImportSheetWriter.readblocks.',
+                        default='csv', required=False, choices=['csv', 'jsonl', 'binary'])
+    parser.add_argument(
+        '--validate', help='Check the import sheet against the schema as it is written.',
+                        default=False, required=False, action="store_true")
+    parser.add_argument(
+        '--validate-sheet', help='Check an existing import sheet against the schema, with --workers processes.',
+                        default=False, required=False)
+    parser.add_argument(
+        '--columnar', help='Map the import sheet in blocks of rows, a column at a time.',
+                        default=False, required=False, action="store_true")
+    parser.add_argument(
+        '--stats', help='Write per-stage timings and counts to stderr as JSON.',
+                        default=False, required=False, action="store_true")
+    parser.add_argument(
+        '--profile', help='Profile a single stage with cProfile, e.g. "map".',
+                        default=None, required=False)
 
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
 
     #	Parse arguments into namespace object to reference later in the script
-    global args
+    global args, outputbuffer, outputgzip
     args = parser.parse_args()
+    outputbuffer = args.buffer_size
+    outputgzip = args.gzip
+
+    if args.csv and not os.path.isfile(args.csv):
+        parser.error("DROID CSV not found: " + args.csv)
+
+    if bool(args.prevcsv) != bool(args.prevsheet):
+        parser.error("--prevcsv and --prevsheet must be used together")
+
+    # each accession is written as a plain CSV sheet with its own external
+    # CSV; options for a single sheet don't carry over
+    if args.accessions:
+        single = [("--csv", args.csv), ("--out", args.out),
+                  ("--buffer-size", args.buffer_size), ("--gzip", args.gzip),
+                  ("--over", args.over), ("--overfile", args.overfile),
+                  ("--ext", args.ext), ("--match-log", args.match_log),
+                  ("--prevcsv", args.prevcsv),
+                  ("--prevsheet", args.prevsheet),
+                  ("--hash-files", args.hash_files),
+                  ("--format", args.format != 'csv'),
+                  ("--stats", args.stats), ("--profile", args.profile)]
+        used = [name for name, value in single if value]
+        if used:
+            parser.error(", ".join(used) + " can't be used with --accessions")
+
+    # rows are only checked as a single import sheet is written
+    if args.validate and (args.validate_sheet or args.accessions or
+                          args.over or not args.csv):
+        parser.error("--validate checks the import sheet written with --csv, "
+                     "use --validate-sheet to check an existing sheet")
+
+    stats = None
+    if args.stats or args.profile:
+        stats = PipelineStats(args.profile)
 
+    hasher = None
+    if args.hash_files:
+        hasher = FileHasher(args.hash_algorithm, args.hash_threads,
+                            args.hash_cache)
+
+    validator = None
+    if args.validate:
+        validator = schemavalidator(jsonschema)
+
+    # What the sheet is made from, to reuse rows from an earlier sheet and
+    # for a later run to reuse this one's
+    record = None
+    if args.csv and not args.over and (args.out or args.prevsheet):
+        hash = None
+        if args.hash_files:
+            hash = args.hash_algorithm or "auto"
+        record = runrecord(configfile, jsonschema, args.ext, args.format,
+                           hash)
+
+    # Checking an import sheet we already have...
+    if args.validate_sheet:
+        sys.stderr.write("Validating import sheet: " + args.validate_sheet
+                         + "\n")
+        if validateImportCSV(args.validate_sheet, jsonschema,
+                             args.workers) > 0:
+            sys.exit(1)
+    # Creating import sheets for many accessions...
+    elif args.accessions:
+        sys.stderr.write("Writing Archway import sheets for accessions in: "
+                         + args.accessions + "\n")
+        if not createBatchImportCSVs(args.accessions, args.outdir,
+                                     jsonschema, configfile, args.workers,
+                                     args.columnar, args.ext_cache):
+            sys.exit(1)
     # Creating an import sheet for Archway...
-    if args.csv and not args.over and not args.ext:
+    elif args.csv and not args.over and not args.ext:
         sys.stderr.write("Writing full Archway import sheet.\n")
         importGenerator = importsheetDROIDmapping(
-            args.csv, jsonschema, configfile)
-        createImportCSV(importGenerator)
+            args.csv, jsonschema, configfile, args.workers, stats,
+            args.prevcsv, args.prevsheet, args.columnar, validator,
+            args.format, hasher, record)
+        createImportCSV(importGenerator, args.out, record)
+        if args.overfile:
+            createCombinedOverview(importGenerator, configfile, args.overfile)
     elif args.csv and not args.over and args.ext:
         sys.stderr.write(
             "Writing full Archway import sheet with external metadata.\n")
         # external mapping is an involved process... it needs full knowledge of
         # two data formats, not least the import sheet layout we require...
         importGenerator = importsheetDROIDmapping(
-            args.csv, jsonschema, configfile)
-        handleExternalCSV(args.ext, importGenerator, configfile, jsonschema)
-        createImportCSV(importGenerator)
+            args.csv, jsonschema, configfile, args.workers, stats,
+            args.prevcsv, args.prevsheet, args.columnar, validator,
+            args.format, hasher, record)
+        matchlog = None
+        if args.match_log:
+            logfile = open(args.match_log, 'wb')
+            matchlog = createMatchLog(logfile)
+        handleExternalCSV(args.ext, importGenerator, configfile, jsonschema,
+                          stats, args.ext_cache, matchlog)
+        createImportCSV(importGenerator, args.out, record)
+        if matchlog is not None:
+            matchlog.close()
+            logfile.close()
+        if args.overfile:
+            createCombinedOverview(importGenerator, configfile, args.overfile)
     # Creating a cover sheet for Archway...
     elif args.csv and args.over:
         sys.stderr.write("Writing Archway overview sheet.\n")
-        createImportOverview(args.csv, configfile)
+        with outputFile(args.out) as outfile:
+            createImportOverview(args.csv, configfile, outfile)
     # We're not doing anything sensible...
     else:
         parser.print_help()
         sys.exit(1)
 
+    if validator is not None:
+        validator.report()
+    if stats is not None:
+        stats.report()
+    # a sheet the import would reject is a failure
+    if validator is not None and validator.violations > 0:
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import csv
+import copy
+import glob
+import json
+import time
+import multiprocessing
+from collections import OrderedDict
+from ImportSheetGenerator import ImportSheetGenerator
+from ExternalCSVHandlerClass import ExternalCSVHandler
+from OutputFile import OutputFile
+from WorkerPool import poolworkers
+
+# The runner used by worker processes, set before the pool is created so
+# that each worker inherits the config and schema already loaded, as with
+# ImportSheetGenerator.workergenerator.
+batchrunner = None
+
+
+def runaccession(accession):
+    return batchrunner.run(accession)
+
+
+# Generate import sheets for many DROID CSVs in one invocation. Config and
+# schema are read once, accessions are processed in a pool of processes,
+# one import sheet is written per DROID CSV and a summary of the run is
+# written alongside them.
+class BatchRunner:
+
+    # in a directory, accession.csv is paired with accession-external.csv
+    externalsuffix = "-external.csv"
+    outputsuffix = "-import.csv"
+    summaryname = "summary.json"
+
+    def __init__(self, importschema, configfile, outdir, workers=1):
+        self.importschema = importschema
+        self.configfile = configfile
+        self.outdir = outdir
+        self.workers = poolworkers(workers)
+        self.cache = None
+        self.externals = {}
+        self.generator = ImportSheetGenerator(False, importschema, configfile)
+        self.generator.loadschema()
+
+    def setColumnar(self, columnar):
+        self.generator.setColumnar(columnar)
+
+    # An ExternalCache shared by every accession
+    def setCache(self, cache):
+        self.cache = cache
+
+    # Returns a list of (DROID CSV, external CSV or None). Raises
+    # ValueError if two accessions would write the same import sheet.
+    def readaccessions(self, path):
+        if os.path.isdir(path):
+            accessions = self.__scandirectory__(path)
+        else:
+            accessions = self.__readmanifest__(path)
+        outputs = {}
+        for droidcsv, externalcsv in accessions:
+            outputs.setdefault(self.outputname(droidcsv), []).append(droidcsv)
+        clashes = [(output, droidcsvs) for output, droidcsvs
+                   in sorted(outputs.items()) if len(droidcsvs) > 1]
+        if clashes:
+            raise ValueError("; ".join(
+                ", ".join(droidcsvs) + " would all be written to " + output
+                for output, droidcsvs in clashes))
+        return accessions
+
+    def __scandirectory__(self, path):
+        accessions = []
+        for droidcsv in sorted(glob.glob(os.path.join(path, "*.csv"))):
+            if droidcsv.endswith(self.externalsuffix) or \
+               droidcsv.endswith(self.outputsuffix):
+                continue
+            externalcsv = droidcsv[:-len(".csv")] + self.externalsuffix
+            if not os.path.isfile(externalcsv):
+                externalcsv = None
+            accessions.append((droidcsv, externalcsv))
+        return accessions
+
+    # One accession per line: DROID CSV[,external CSV]. Paths are relative
+    # to the manifest, blank lines and lines starting with # are skipped.
+    def __readmanifest__(self, path):
+        accessions = []
+        manifestdir = os.path.dirname(path)
+        with open(path, 'rb') as manifest:
+            for row in csv.reader(manifest):
+                row = [value.strip() for value in row]
+                if not row or row[0] == "" or row[0].startswith("#"):
+                    continue
+                droidcsv = os.path.join(manifestdir, row[0])
+                externalcsv = None
+                if len(row) > 1 and row[1] != "":
+                    externalcsv = os.path.join(manifestdir, row[1])
+                accessions.append((droidcsv, externalcsv))
+        return accessions
+
+    def outputname(self, droidcsv):
+        name = os.path.splitext(os.path.basename(droidcsv))[0]
+        return os.path.join(self.outdir, name + self.outputsuffix)
+
+    def runall(self, accessions):
+        global batchrunner
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        start = time.time()
+        self.readexternals(accessions)
+        if self.workers > 1 and len(accessions) > 1:
+            batchrunner = self
+            pool = multiprocessing.Pool(min(self.workers, len(accessions)))
+            try:
+                results = pool.map(runaccession, accessions, 1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+                batchrunner = None
+        else:
+            results = [self.run(accession) for accession in accessions]
+        summary = self.summarise(results, time.time() - start)
+        with open(os.path.join(self.outdir, self.summaryname), 'wb') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    # Each distinct external CSV is read once, before forking, so workers
+    # share the index and never write the same cache entry at once. A CSV
+    # that can't be read fails only the accessions that use it.
+    def readexternals(self, accessions):
+        externalcsvs = sorted(set(a[1] for a in accessions
+                                  if a[1] is not None))
+        if not externalcsvs:
+            return
+        handler = ExternalCSVHandler(self.configfile, self.importschema)
+        handler.setCache(self.cache)
+        for externalcsv in externalcsvs:
+            try:
+                if not os.path.isfile(externalcsv):
+                    raise IOError("External CSV not found: " + externalcsv)
+                self.externals[externalcsv] = \
+                    handler.readExternalCSV(externalcsv)
+            except Exception as e:
+                self.externals[externalcsv] = e
+
+    def run(self, accession):
+        droidcsv, externalcsv = accession
+        output = self.outputname(droidcsv)
+        result = OrderedDict([("droid", droidcsv),
+                              ("external", externalcsv),
+                              ("output", output)])
+        start = time.time()
+        try:
+            generator = copy.copy(self.generator)
+            generator.droidcsv = droidcsv
+            if not os.path.isfile(droidcsv):
+                raise IOError("DROID CSV not found: " + droidcsv)
+            if externalcsv is not None:
+                external = self.externals[externalcsv]
+                if isinstance(external, Exception):
+                    raise external
+                generator.setExternalCSV(external.share())
+            with OutputFile(output) as outfile:
+                generator.setOutfile(outfile)
+                generator.droid2archwayimport()
+            handler = generator.droidcsvhandler
+            result["rows read"] = handler.rowcount
+            result["folders"] = handler.foldercount
+            result["container contents"] = handler.containercount
+            result["rows written"] = generator.droidcount
+            if generator.externalCSV is not None:
+                result["external rows"] = len(generator.externalCSV)
+                result["external misses"] = generator.externalCSV.misscount
+                result["external ambiguous"] = \
+                    generator.externalCSV.ambiguouscount
+        except Exception as e:
+            sys.stderr.write("Failed to process " + droidcsv + ": " +
+                             str(e) + "\n")
+            result["error"] = str(e)
+        result["seconds"] = round(time.time() - start, 4)
+        return result
+
+    def summarise(self, results, seconds):
+        failed = [r for r in results if "error" in r]
+        return OrderedDict([
+            ("accessions", len(results)),
+            ("succeeded", len(results) - len(failed)),
+            ("failed", len(failed)),
+            ("rows written", sum(r.get("rows written", 0) for r in results)),
+            ("seconds", round(seconds, 4)),
+            ("results", results)])
+
+    def report(self, summary):
+        for result in summary["results"]:
+            status = result.get("error", "%d rows" % result.get(
+                "rows written", 0))
+            sys.stderr.write(result["droid"] + " -> " + result["output"] +
+                             ": " + status + "\n")
+        sys.stderr.write("Accessions: %d, succeeded: %d, failed: %d\n"
+                         % (summary["accessions"], summary["succeeded"],
+                            summary["failed"]))
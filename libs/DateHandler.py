@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+
+# Small least-recently-used cache. DROID reports and agency exports repeat
+# the same date strings many times over, e.g. a whole folder saved at once.
+# Entries are links, [previous, next, key, value], in a circular list kept
+# in order of use; OrderedDict does the same in Python 2 but at several
+# times the cost per hit.
+class LRUCache:
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.cache = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def get(self, key):
+        link = self.cache.get(key)
+        if link is None:
+            return None
+        # move the link to the most recently used end, before root
+        previous, following, key, value = link
+        previous[1] = following
+        following[0] = previous
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return value
+
+    # For keys not already in the cache
+    def put(self, key, value):
+        root = self.root
+        if len(self.cache) >= self.size:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.cache[oldest[2]]
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = link
+        self.cache[key] = link
+
+
+# Fast parsers return the year as an integer, or None when the string needs
+# the full strptime treatment. They validate the fixed layout and the field
+# ranges themselves; days past the 28th are left to strptime so that month
+# lengths and leap years are checked exactly as before.
+
+def checkedyear(year, month, day, hour=0, minute=0, second=0):
+    if not (1 <= month <= 12 and 1 <= day <= 28):
+        return None
+    if not (hour <= 23 and minute <= 59 and second <= 59):
+        return None
+    if year < 1:
+        return None
+    return year
+
+
+# DROID: 2014-12-31T16:10:09
+def isodatetimeyear(value):
+    if len(value) != 19 or value[4] != '-' or value[7] != '-' or \
+       value[10] != 'T' or value[13] != ':' or value[16] != ':':
+        return None
+    digits = value[0:4] + value[5:7] + value[8:10] + \
+        value[11:13] + value[14:16] + value[17:19]
+    if not digits.isdigit():
+        return None
+    return checkedyear(int(value[0:4]), int(value[5:7]),
+                       int(value[8:10]), int(value[11:13]),
+                       int(value[14:16]), int(value[17:19]))
+
+
+# e.g. 1/05/2017
+def dmyyear(value):
+    parts = value.split('/')
+    if len(parts) != 3 or len(parts[2]) != 4:
+        return None
+    for part in parts:
+        if not part.isdigit():
+            return None
+    return checkedyear(int(parts[2]), int(parts[1]), int(parts[0]))
+
+
+# e.g. 20141231161009
+def ymdhmsyear(value):
+    if len(value) != 14 or not value.isdigit():
+        return None
+    return checkedyear(int(value[0:4]), int(value[4:6]),
+                       int(value[6:8]), int(value[8:10]),
+                       int(value[10:12]), int(value[12:14]))
+
+
+class YearParser:
+
+    def __init__(self, fastparser, inputformat, cachesize=4096):
+        self.fastparser = fastparser
+        self.inputformat = inputformat
+        self.cache = LRUCache(cachesize)
+
+    # Raises ValueError for strings strptime can't parse, as it always has
+    def year(self, value):
+        year = self.cache.get(value)
+        if year is None:
+            year = self.fastparser(value)
+            if year is None:
+                year = datetime.strptime(value, self.inputformat).year
+            self.cache.put(value, year)
+        return year
+
+
+droiddateformat = '%Y-%m-%dT%H:%M:%S'
+
+# 'Date Pattern' values from the config we know how to convert. The fast
+# parser is tried first, strptime with the format is the fallback.
+datepatterns = {
+    r"^[1-9]\d?\/\d{2}\/\d{4}$": (dmyyear, '%d/%m/%Y'),
+    r"^([12][0-9]{3})(0[1-9]|1[0-2])(0[1-9]|1[1-9]|2[1-9]|3[0-1])"
+    r"(0[1-9]|1[1-9]|2[0-3])([0-5][0-9])([0-5][0-9])$":
+        (ymdhmsyear, '%Y%m%d%H%M%S'),
+}
+
+
+def droidyearparser():
+    return YearParser(isodatetimeyear, droiddateformat)
+
+
+# Returns None if there is no handler for the configured pattern
+def patternyearparser(pattern):
+    if pattern in datepatterns:
+        fastparser, inputformat = datepatterns[pattern]
+        return YearParser(fastparser, inputformat)
+    return None
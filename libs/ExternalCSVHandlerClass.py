@@ -4,22 +4,27 @@ import sys
 import unicodecsv
 import ConfigParser
 from os.path import exists
-from datetime import datetime
 
 from droidcsvhandlerclass import *
+from ExternalIndex import ExternalIndex
+from DateHandler import patternyearparser
+from PathMasker import configmasker
+from PipelineStats import NoStats
 
 # Table schema code...
 sys.path.append(r'JsonTableSchema/')
 import JsonTableSchema
 
 
-class NewRow:
-    checksum = ""
-    path = ""
-    rdict = {}
+# values is a tuple aligned to the import schema columns, None where the
+# external CSV has nothing for a column.
+class NewRow(object):
+    __slots__ = ['checksum', 'path', 'values']
 
     def __init__(self):
-        self.rdict = {}  # shares memory if not initialized every call?
+        self.checksum = ""
+        self.path = ""
+        self.values = ()
 
 
 class ExternalCSVHandler:
@@ -40,20 +45,33 @@ class ExternalCSVHandler:
     datepattern = "Date Pattern"
     desctext = "descriptiontext"
 
-    rowdict = {}
-    maphead = []
+    # values checked for dates in a column before giving up on it
+    datesample = 1000
 
     def __init__(self, configfile, importschema):
         self.config = ConfigParser.RawConfigParser()
 
         self.configfile = configfile
         self.importschema = importschema
+        self.stats = NoStats()
+        self.cache = None
+
+        self.rowdict = {}
+        self.maphead = []
 
         self.__getconfig__()
         self.__getheaders__()
 
         self.__getmappingtable__()
 
+    def setStats(self, stats):
+        if stats is not None:
+            self.stats = stats
+
+    # An ExternalCache to keep parsed rows in between runs
+    def setCache(self, cache):
+        self.cache = cache
+
     def __checkconfig__(self, section, name):
         if self.config.has_option(section, name):
             var = self.config.get(section, name)
@@ -66,7 +84,8 @@ class ExternalCSVHandler:
         self.config.read(self.configfile)
 
         # retrieve values...
-        self.pathmask = self.__checkconfig__(self.mapconfig, self.pathmask)
+        self.pathmasker = configmasker(
+            self.config, self.mapconfig, self.pathmask)
         self.checksumcol = self.__checkconfig__(
             self.mapconfig, self.checksumcolumn)
         self.pathcol = self.__checkconfig__(self.mapconfig, self.pathcolumn)
@@ -76,19 +95,19 @@ class ExternalCSVHandler:
         # access our regular expression for dates...
         self.userdatepattern = self.__checkconfig__(
             self.mapconfig, self.datepattern)
+        self.dates = None
+        self.dateparser = None
         if self.userdatepattern is not None:
             self.dates = re.compile(self.userdatepattern)
+            self.dateparser = patternyearparser(self.userdatepattern)
         return
 
     # Read the import sheet headers from our CSV schema file...
     def __getheaders__(self):
         sys.stderr.write(
             "Import schema being read from: " + self.importschema + "\n")
-        f = open(self.importschema, 'rb')
-        importschemajson = f.read()
-        importschema = JsonTableSchema.JSONTableSchema(importschemajson)
+        importschema = JsonTableSchema.load_schema(self.importschema)
         self.importheaders = importschema.as_list()
-        f.close()
         return
 
     # Using the CSV headers, see if there is an entry in the config file
@@ -108,94 +127,164 @@ class ExternalCSVHandler:
 
         sys.stderr.write("Mapped fields ({external field: import field}): %s\n" % self.rowdict)
 
+        # (external field, import column position, import column name), a
+        # field mapped to more than one column goes to the last, as above
+        columnindex = dict((name, i) for i, name in
+                           enumerate(self.importheaders))
+        self.mapcolumns = []
+        for f in self.maphead:
+            if f not in [m[0] for m in self.mapcolumns]:
+                self.mapcolumns.append(
+                    (f, columnindex[self.rowdict[f]], self.rowdict[f]))
+
     # Read the external CSV we want to extract metadata from...
     def readExternalCSV(self, extcsvname):
+        key = None
+        augmented = None
+        if self.cache is not None and exists(extcsvname):
+            with self.stats.stage("external cache"):
+                key = self.cache.key(extcsvname, self.config,
+                                     [self.mapconfig, self.mapping],
+                                     self.importheaders)
+                augmented = self.__loadcached__(extcsvname, key)
+        if augmented is None:
+            augmented = self.__readrows__(extcsvname)
+            if key is not None:
+                with self.stats.stage("external cache"):
+                    self.cache.save(extcsvname, key, [
+                        (row.checksum, row.path, row.values)
+                        for row in augmented])
+        with self.stats.stage("external index"):
+            index = self.__buildindex__(augmented)
+        self.stats.addrows("external index", len(augmented), len(index))
+        return index
+
+    # Parse and describe the rows of the external CSV...
+    def __readrows__(self, extcsvname):
         augmented = []  # augmented metadata
-        exportlist = None
         if exists(extcsvname):
-            csvhandler = genericCSVHandler()
-            exportlist = csvhandler.csvaslist(extcsvname)
-            # counter a blank sheet
-            if len(exportlist) < 1:
-                exportlist = None
-            if exportlist is not None:
-                for e in exportlist:
-                    # we need to differentiate in case we get non-unique values
-                    nscount = 0
-                    row = NewRow()
-                    if e[self.checksumcol] != "":
-                        row.checksum = e[self.checksumcol]
-                    if e[self.pathcol] != "":
-                        row.path = e[self.pathcol].replace(self.pathmask, "")
-                    for f in e:
-                        if f in self.maphead:
-                            data = e[f].strip() # remove trailing ws early
-                            if re.match(self.dates, data):
-                                data = self.__fixdates__(data)
-                            # data is data, unless dates, but if dates, append
-                            if self.rowdict[f] == 'Description':
-                                if data != "":
-                                    nscount += 1
-                                    data = f + ": " + data
-                                    data = "ns" + str(nscount) + ":" + data
-                                    row.rdict[data] = self.rowdict[f]
-                            else:
-                                nscount += 1
-                                data = "ns" + str(nscount) + ":" + data
-                                row.rdict[data] = self.rowdict[f]
+            # only the columns we match on or map are kept
+            columns = set(self.maphead) | set([self.checksumcol,
+                                               self.pathcol])
+            reader = CSVRowReader(extcsvname, columns)
+            self.index = reader.index
+            self.__compileheader__(reader.index)
+            rowcount = 0
+            with self.stats.stage("external parse"):
+                for e in reader:
+                    rowcount += 1
+                    row = self.__parserow__(e)
                     if row.checksum != "":
                         augmented.append(row)
-
-        return self.__fixdescription__(augmented)
-
-    def splitns(self, value):
-        return value.split(':', 1)[1]
+            self.stats.addrows("external parse", rowcount, len(augmented))
+
+        with self.stats.stage("external describe"):
+            augmented = self.__fixdescription__(augmented)
+        self.stats.addrows("external describe", len(augmented),
+                           len(augmented))
+        return augmented
+
+    # Rows from a previous run's cache, exactly as __readrows__ left them
+    def __loadcached__(self, extcsvname, key):
+        records = self.cache.load(extcsvname, key)
+        if records is None:
+            self.stats.setcount("external cache hit", 0)
+            return None
+        sys.stderr.write("External CSV metadata read from cache.\n")
+        self.stats.setcount("external cache hit", 1)
+        augmented = []
+        for checksum, path, values in records:
+            row = NewRow()
+            row.checksum = checksum
+            row.path = path
+            row.values = values
+            augmented.append(row)
+        return augmented
+
+    # Work out once per file which columns of a row are mapped, and where
+    # to, so each row is a straight loop over the columns present.
+    def __compileheader__(self, index):
+        self.checksumpos = index[self.checksumcol]
+        self.pathpos = index[self.pathcol]
+        self.rowplan = []
+        for f, i, column in self.mapcolumns:
+            if f in index:
+                self.rowplan.append(
+                    (index[f], i, column == 'Description', f + ": "))
+        # Values left to check for dates per column: checking stops once a
+        # column has had datesample values in a row that aren't dates, and
+        # never stops for a column that has had a date.
+        budget = 0
+        if self.dates is not None:
+            budget = self.datesample
+        self.datebudget = [budget] * len(self.rowplan)
+
+    def __parserow__(self, e):
+        row = NewRow()
+        checksum = e[self.checksumpos]
+        if checksum != "":
+            row.checksum = checksum
+        path = e[self.pathpos]
+        if path != "":
+            row.path = self.pathmasker.strip(path)
+        values = [None] * len(self.importheaders)
+        datebudget = self.datebudget
+        for k, (position, i, description, label) in enumerate(self.rowplan):
+            data = e[position].strip() # remove trailing ws early
+            if datebudget[k] != 0 and data != "":
+                if self.dates.match(data):
+                    data = self.__fixdates__(data)
+                    datebudget[k] = -1
+                elif datebudget[k] > 0:
+                    datebudget[k] -= 1
+            # data is data, unless dates, but if dates, append
+            if description:
+                # several fields may describe a record, collect them all
+                if data != "":
+                    if values[i] is None:
+                        values[i] = []
+                    values[i].append(label + data)
+            elif values[i] is None:
+                values[i] = data
+        row.values = values
+        return row
+
+    # Key the augmented rows so DROID rows can be matched in constant time
+    def __buildindex__(self, augmented_list):
+        index = ExternalIndex()
+        for row in augmented_list:
+            index.add(row)
+        index.reportduplicates()
+        return index
 
     def __fixdescription__(self, augmented_list):
 
         for row in augmented_list:
 
-            newrow = {}
-            desc = ""
-            title = ""
-            temprow = row.rdict
-
-            # Declare these early to work with them below.
-            opendate = ''
-            close = ''
-
-            for r in temprow:
-                if temprow[r] == 'Description':
-                    desc = desc + self.splitns(r).encode('utf-8') + ". "
-                elif temprow[r] == 'Open Year':
-                    opendate = self.splitns(r).encode('utf-8')
-                    newrow[r] = opendate
-                elif temprow[r] == 'Close Year':
-                    close = self.splitns(r).encode('utf-8')
-                    newrow[r] = close
-                else:
-                    newrow[r] = temprow[r]
-            '''
-            if opendate != '' and close != '':
-                if int(opendate) > int(close):
-                    sys.stderr.write(
-                        "Dates incorrect open: " + opendate + " close: " + \
-                        close + "\n")
-			'''
-            if desc != '' and self.descriptiontext != None:
-                desc = desc + self.descriptiontext
-                newrow[desc] = 'Description'
-
-            row.rdict = newrow
-            
+            values = row.values
+
+            for i, column in enumerate(self.importheaders):
+                if values[i] is None:
+                    continue
+                if column == 'Description':
+                    desc = ""
+                    for d in values[i]:
+                        desc = desc + d.encode('utf-8') + ". "
+                    if self.descriptiontext != None:
+                        values[i] = desc + self.descriptiontext
+                    else:
+                        values[i] = None
+                elif column == 'Open Year' or column == 'Close Year':
+                    values[i] = values[i].encode('utf-8')
+
+            row.values = tuple(values)
+
         return augmented_list
 
     # Convert dates from one format to another...
     def __fixdates__(self, dates):
-        if self.userdatepattern == "^[1-9]\d?\/\d{2}\/\d{4}$":
-            dateobj = datetime.strptime(dates, '%d/%m/%Y')
-            # return dateobj.strftime("%Y-%m-%d")
-            return dateobj.strftime("%Y")
+        if self.dateparser is not None:
+            return str(self.dateparser.year(dates))
         else:
             sys.stderr.write(
                 "No date handler configured for this string: " + dates)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import hashlib
+import cPickle
+import tempfile
+from OutputFile import replacefile
+
+
+# On-disk cache of processed external CSV records. Entries are keyed on the
+# external file's size, mtime and content hash, plus the config sections and
+# schema columns that shape the records, so editing either the file or the
+# mapping invalidates the cache without any further action.
+class ExternalCache:
+
+    # bump when the record layout changes
+    formatversion = 1
+
+    readsize = 1 << 20
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+    def key(self, extcsvname, config, sections, importheaders):
+        st = os.stat(extcsvname)
+        key = hashlib.sha1()
+        key.update("format %d\n" % self.formatversion)
+        key.update("size %d mtime %r\n" % (st.st_size, st.st_mtime))
+        key.update("content %s\n" % self.__contenthash__(extcsvname))
+        for section in sections:
+            key.update("[%s]\n" % section)
+            if config.has_section(section):
+                for name, value in sorted(config.items(section)):
+                    key.update("%s=%s\n" % (name, value))
+        key.update("columns %r\n" % (importheaders,))
+        return key.hexdigest()
+
+    def __contenthash__(self, extcsvname):
+        content = hashlib.sha1()
+        with open(extcsvname, 'rb') as f:
+            while True:
+                data = f.read(self.readsize)
+                if not data:
+                    break
+                content.update(data)
+        return content.hexdigest()
+
+    # One entry is kept per external file; its name starts with a hash of
+    # the file's path so stale entries for that file can be removed.
+    def __prefix__(self, extcsvname):
+        return hashlib.sha1(os.path.abspath(extcsvname)).hexdigest()[:16]
+
+    def __filename__(self, extcsvname, key):
+        return os.path.join(self.cachedir, "%s-%s.cache"
+                            % (self.__prefix__(extcsvname), key))
+
+    # Returns a list of (checksum, path, values) tuples, or None on a miss
+    def load(self, extcsvname, key):
+        cachefile = self.__filename__(extcsvname, key)
+        if not os.path.isfile(cachefile):
+            return None
+        try:
+            with open(cachefile, 'rb') as f:
+                return cPickle.load(f)
+        except (EOFError, cPickle.UnpicklingError):
+            sys.stderr.write("Ignoring unreadable external cache: " +
+                             cachefile + "\n")
+            return None
+
+    def save(self, extcsvname, key, records):
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        prefix = self.__prefix__(extcsvname)
+        cachefile = self.__filename__(extcsvname, key)
+        # another process may be saving or cleaning up the same entry
+        for name in os.listdir(self.cachedir):
+            if name.startswith(prefix + "-") and name.endswith(".cache") \
+               and name != os.path.basename(cachefile):
+                try:
+                    os.remove(os.path.join(self.cachedir, name))
+                except OSError:
+                    pass
+        # written to the side and renamed so a reader never sees half a
+        # file, under a name of its own so concurrent saves don't collide
+        fd, temppath = tempfile.mkstemp(dir=self.cachedir,
+                                        prefix=prefix + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(records, f, cPickle.HIGHEST_PROTOCOL)
+            replacefile(temppath, cachefile)
+        except:
+            os.remove(temppath)
+            raise
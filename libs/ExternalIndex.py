@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import copy
+import sys
+
+
+# Normalise a path for use as an index key. Agency exports are not always
+# consistent with DROID about separators or surrounding whitespace.
+def normalisepath(path):
+    return path.strip().replace('/', '\\')
+
+
+# Paths compared on their own, when checksums don't match, also ignore case
+def foldpath(path):
+    return normalisepath(path).lower()
+
+
+def normalisechecksum(checksum):
+    return checksum.strip().upper()
+
+
+class ExternalIndex:
+
+    # number of example misses to list in the summary
+    missexamples = 10
+
+    def __init__(self):
+        self.rows = []
+        self.bykey = {}         # (path, checksum): row
+        self.bychecksum = {}    # checksum: row
+        self.bypath = {}        # folded path: row
+        # checksums and folded paths on more than one row, only ever
+        # matched together with the other
+        self.ambiguouschecksums = set()
+        self.ambiguouspaths = set()
+
+        self.duplicatekeys = 0
+        self.duplicatechecksums = 0
+        self.duplicatepaths = 0
+
+        self.exacthits = 0
+        self.checksumhits = 0
+        self.pathhits = 0
+        self.misses = []
+        self.misscount = 0
+        self.ambiguouscount = 0
+        self.matchlog = None
+
+    # A CSVSheetWriter to record how each DROID row was matched
+    def setMatchLog(self, matchlog):
+        self.matchlog = matchlog
+
+    def __len__(self):
+        return len(self.rows)
+
+    # The same index with match counters of its own, e.g. for each
+    # accession of a batch that shares an external CSV
+    def share(self):
+        index = copy.copy(self)
+        index.exacthits = 0
+        index.checksumhits = 0
+        index.pathhits = 0
+        index.misses = []
+        index.misscount = 0
+        index.ambiguouscount = 0
+        index.matchlog = None
+        return index
+
+    # Add a row from the external CSV. The first row seen for any given key
+    # wins, as with the original linear scan of the external CSV.
+    def add(self, row):
+        self.rows.append(row)
+        path = normalisepath(row.path)
+        checksum = normalisechecksum(row.checksum)
+
+        key = (path, checksum)
+        if key in self.bykey:
+            self.duplicatekeys += 1
+        else:
+            self.bykey[key] = row
+
+        if checksum in self.bychecksum:
+            self.duplicatechecksums += 1
+            self.ambiguouschecksums.add(checksum)
+        else:
+            self.bychecksum[checksum] = row
+
+        if path != "":
+            path = path.lower()
+            if path in self.bypath:
+                self.duplicatepaths += 1
+                self.ambiguouspaths.add(path)
+            else:
+                self.bypath[path] = row
+
+    # Find the external row for a DROID row; exact (path, checksum) first,
+    # then checksum alone, then path alone with case folded. Every exact
+    # key's checksum is also in bychecksum, so a checksum that isn't there
+    # goes straight to the path lookup. A checksum or path shared by several
+    # rows, e.g. that of an empty file, could be any of them, so it is only
+    # matched exactly; a row left unmatched because of one is a miss
+    # counted as ambiguous.
+    def lookup(self, checksum, path):
+        path = normalisepath(path)
+        checksum = normalisechecksum(checksum)
+
+        row = None
+        ambiguous = False
+        if checksum in self.bychecksum:
+            row = self.bykey.get((path, checksum))
+            if row is not None:
+                self.exacthits += 1
+                tier = "exact"
+            elif checksum in self.ambiguouschecksums:
+                ambiguous = True
+            elif checksum != "":
+                row = self.bychecksum[checksum]
+                self.checksumhits += 1
+                tier = "checksum"
+
+        if row is None:
+            folded = path.lower()
+            if folded in self.ambiguouspaths:
+                ambiguous = True
+            else:
+                row = self.bypath.get(folded)
+            if row is not None:
+                self.pathhits += 1
+                tier = "path"
+            else:
+                self.misscount += 1
+                if len(self.misses) < self.missexamples:
+                    self.misses.append((path, checksum))
+                tier = "miss"
+                if ambiguous:
+                    self.ambiguouscount += 1
+                    tier = "ambiguous"
+
+        if self.matchlog is not None:
+            self.matchlog.writerow([path, checksum, tier])
+        return row
+
+    # Match counters are taken and merged when DROID rows are mapped in
+    # worker processes, each of which holds its own copy of the index.
+    def takecounts(self):
+        log = None
+        if self.matchlog is not None:
+            log = (self.matchlog.getvalue(), self.matchlog.rowcount)
+            self.matchlog.clear()
+        counts = (self.exacthits, self.checksumhits, self.pathhits,
+                  self.misscount, self.ambiguouscount, self.misses, log)
+        self.exacthits = 0
+        self.checksumhits = 0
+        self.pathhits = 0
+        self.misscount = 0
+        self.ambiguouscount = 0
+        self.misses = []
+        return counts
+
+    def addcounts(self, counts):
+        exacthits, checksumhits, pathhits, misscount, ambiguouscount, \
+            misses, log = counts
+        self.exacthits += exacthits
+        self.checksumhits += checksumhits
+        self.pathhits += pathhits
+        self.misscount += misscount
+        self.ambiguouscount += ambiguouscount
+        space = self.missexamples - len(self.misses)
+        if space > 0:
+            self.misses.extend(misses[:space])
+        if log is not None and self.matchlog is not None:
+            self.matchlog.writeraw(*log)
+
+    def reportduplicates(self):
+        if self.duplicatekeys or self.duplicatechecksums or \
+           self.duplicatepaths:
+            sys.stderr.write(
+                "External CSV duplicates (first row kept for exact matches, "
+                "none used for checksum or path only matches): %d path and "
+                "checksum, %d checksum only, %d path only\n"
+                % (self.duplicatekeys, self.duplicatechecksums,
+                   self.duplicatepaths))
+
+    def reportmatches(self):
+        sys.stderr.write(
+            "External matches: %d exact, %d checksum only, %d path only, "
+            "%d missed (%d ambiguous)\n"
+            % (self.exacthits, self.checksumhits, self.pathhits,
+               self.misscount, self.ambiguouscount))
+        for path, checksum in self.misses:
+            sys.stderr.write("    No external row for: " +
+                             path.encode('utf-8') + " " +
+                             checksum.encode('utf-8') + "\n")
+        if self.misscount > len(self.misses):
+            sys.stderr.write("    ... and %d more\n"
+                             % (self.misscount - len(self.misses)))
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import codecs
+import hashlib
+import cPickle
+import itertools
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from OutputFile import OutputFile
+
+# Encoding for DROID's unicode paths where the platform doesn't take them
+# as they are, UTF-8 if Python only knows the filesystem as ASCII
+fsencoding = sys.getfilesystemencoding() or "ascii"
+if codecs.lookup(fsencoding).name == "ascii":
+    fsencoding = "utf-8"
+
+
+def ospath(path):
+    if isinstance(path, unicode) and not os.path.supports_unicode_filenames:
+        return path.encode(fsencoding)
+    return path
+
+
+# Computes the checksums DROID didn't, for reports made with hashing turned
+# off, by reading the files the report lists. Files are read in large blocks
+# in a pool of threads; hashlib releases the GIL while it digests a block,
+# so reads and hashing overlap. Digests can be kept in a cache file between
+# runs, keyed on the path and checked against the file's size and mtime.
+class FileHasher:
+
+    # DROID column for each algorithm, in the order a column is looked for
+    hashcolumns = OrderedDict([("md5", "MD5_HASH"),
+                               ("sha1", "SHA1_HASH"),
+                               ("sha256", "SHA256_HASH")])
+
+    readsize = 1 << 20
+    threads = 8
+
+    # rows handed to the pool at a time
+    chunksize = 512
+
+    # unreadable files written out in full, the rest are only counted
+    maxreported = 10
+
+    def __init__(self, algorithm=None, threads=None, cachefile=None):
+        self.algorithm = algorithm
+        if threads is not None and threads > 0:
+            self.threads = threads
+        self.cachefile = cachefile
+        self.cache = {}
+        self.cachechanged = False
+        if cachefile:
+            self.cache = self.__loadcache__()
+        self.column = None
+        self.present = 0
+        self.hashed = 0
+        self.cached = 0
+        self.failed = 0
+        self.failures = []
+
+    # Fill in the checksum column of DROID row tuples from filterfiles. The
+    # column is chosen, and added to index if the report doesn't have it,
+    # straight away so the mapping can be compiled before any row is read.
+    def hashrows(self, rows, index):
+        added = self.__bindcolumn__(index)
+        return self.__hashrows__(rows, index[self.column],
+                                 index['FILE_PATH'], added)
+
+    # Returns True if the column was added to the index
+    def __bindcolumn__(self, index):
+        if self.algorithm is None:
+            self.algorithm = "md5"
+            for algorithm, column in self.hashcolumns.items():
+                if column in index:
+                    self.algorithm = algorithm
+                    break
+        self.column = self.hashcolumns[self.algorithm]
+        if self.column in index:
+            return False
+        index[self.column] = len(index)
+        return True
+
+    def __hashrows__(self, rows, column, pathcol, added):
+        rows = iter(rows)
+        pool = ThreadPool(self.threads)
+        try:
+            while True:
+                chunk = list(itertools.islice(rows, self.chunksize))
+                if not chunk:
+                    break
+                if added:
+                    chunk = [row + (u"",) for row in chunk]
+                missing = [i for i, row in enumerate(chunk)
+                           if row[column] == ""]
+                self.present += len(chunk) - len(missing)
+                if missing:
+                    results = pool.map(self.digest, [chunk[i][pathcol]
+                                                     for i in missing])
+                    for i, digest in itertools.izip(missing, results):
+                        row = list(chunk[i])
+                        row[column] = self.__record__(row[pathcol], digest)
+                        chunk[i] = tuple(row)
+                for row in chunk:
+                    yield row
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        self.savecache()
+
+    # Runs in the pool. Returns (status, digest, size, mtime), status is
+    # "cached", "hashed" or the reason the file couldn't be read.
+    def digest(self, path):
+        try:
+            st = os.stat(ospath(path))
+            entry = self.cache.get((self.algorithm, path))
+            if entry is not None and entry[:2] == (st.st_size, st.st_mtime):
+                return "cached", entry[2], st.st_size, st.st_mtime
+            digest = hashlib.new(self.algorithm)
+            with open(ospath(path), 'rb') as f:
+                while True:
+                    data = f.read(self.readsize)
+                    if not data:
+                        break
+                    digest.update(data)
+            return "hashed", digest.hexdigest(), st.st_size, st.st_mtime
+        except (IOError, OSError) as e:
+            return e.strerror or str(e), u"", None, None
+
+    # Counts and caches a result, in the main thread, returns the digest
+    def __record__(self, path, result):
+        status, digest, size, mtime = result
+        if status == "cached":
+            self.cached += 1
+        elif status == "hashed":
+            self.hashed += 1
+            self.cache[(self.algorithm, path)] = (size, mtime, digest)
+            self.cachechanged = True
+        else:
+            self.failed += 1
+            if len(self.failures) < self.maxreported:
+                self.failures.append((path, status))
+        return unicode(digest)
+
+    def __loadcache__(self):
+        if not os.path.isfile(self.cachefile):
+            return {}
+        try:
+            with open(self.cachefile, 'rb') as f:
+                return cPickle.load(f)
+        except (EOFError, cPickle.UnpicklingError):
+            sys.stderr.write("Ignoring unreadable hash cache: " +
+                             self.cachefile + "\n")
+            return {}
+
+    def savecache(self):
+        if self.cachefile and self.cachechanged:
+            with OutputFile(self.cachefile, compress=False) as f:
+                cPickle.dump(self.cache, f, cPickle.HIGHEST_PROTOCOL)
+            self.cachechanged = False
+
+    def reportcounts(self):
+        for path, reason in self.failures:
+            sys.stderr.write(u"Unable to hash {0}: {1}\n".format(
+                path, reason).encode('utf-8'))
+        if self.failed > len(self.failures):
+            sys.stderr.write("... %d more\n"
+                             % (self.failed - len(self.failures)))
+        sys.stderr.write(
+            "%s checksums: %d in the DROID CSV, %d hashed, %d from cache, "
+            "%d unreadable\n" % (self.column, self.present, self.hashed,
+                                 self.cached, self.failed))
@@ -3,6 +3,7 @@
 import sys
 import ConfigParser
 from droidcsvhandlerclass import *
+from PathMasker import configmasker
 
 
 class ImportOverviewGenerator:
@@ -13,25 +14,33 @@ class ImportOverviewGenerator:
             self.config.read(configfile)
         self.droidcsv = droidcsv
 
+    # Folders gathered elsewhere, e.g. while the import sheet was generated
+    # from the same read of the DROID CSV.
+    def setFolderList(self, folders):
+        self.droidlist = folders
+
     # TODO: Quick and dirty... rework so it's a little more refined
-    def outputOverview(self):
-        uniquefolderlist = set(self.droidlist)
+    def outputOverview(self, outfile=None):
+        if outfile is None:
+            outfile = sys.stdout
+        uniquefolderlist = self.droidlist
         folderlist = []
 
-        # TODO: Check for existence of key...?
-        pathmask = self.config.get('additional values', 'pathmask')
+        pathmasker = configmasker(self.config, 'additional values',
+                                  'pathmask')
 
         for folder in uniquefolderlist:
-            foldertext = str(folder).replace(pathmask, "")
-            # replace doesn't seem to capture all options
-            if foldertext not in pathmask:     # foldertext subset of pathmask
-                folderlist.append(foldertext)
+            foldertext = pathmasker.strip(folder)
+            # the masked folders and those above them aren't listed
+            if foldertext != "" and not pathmasker.covers(folder):
+                folderlist.append(foldertext.encode('utf-8'))
 
-        sys.stdout.write('"Archway Listing Template"' + '\n')
-        sys.stdout.write('"Access Restrictions:"' + '\n')
-        sys.stdout.write('"Agency Comment:"' + '\n\n')
+        lines = []
+        lines.append('"Archway Listing Template"' + '\n')
+        lines.append('"Access Restrictions:"' + '\n')
+        lines.append('"Agency Comment:"' + '\n\n')
 
-        sys.stdout.write('"Agency","Accession","Series","Sub Series"' + '\n')
+        lines.append('"Agency","Accession","Series","Sub Series"' + '\n')
 
         agency = self.config.get('static values', 'Agency')
         series = self.config.get('static values', 'Actual Series')
@@ -42,16 +51,26 @@ class ImportOverviewGenerator:
         # series + '",' + '"' + folderlist[0] + '"' + '\n')
 
         for folder in folderlist:
-            sys.stdout.write('"' + agency + '",' + '"' + accession +
-                             '",' + '"' + series + '",' + '"' + folder + '"' + '\n')
+            lines.append('"' + agency + '",' + '"' + accession +
+                         '",' + '"' + series + '",' + '"' + folder + '"' + '\n')
+
+        outfile.write("".join(lines))
+        outfile.flush()
 
     def readDROIDCSV(self):
         if self.droidcsv != False:
             droidcsvhandler = droidCSVHandler()
-            droidlist = droidcsvhandler.readDROIDCSV(self.droidcsv)
-            return droidcsvhandler.retrievefolderlist(droidlist)
+            droidrows = droidcsvhandler.iterDROIDCSV(
+                self.droidcsv, droidcsvhandler.filtercolumns)
+            # only unique folder paths are kept, in the order DROID lists them
+            for row in droidcsvhandler.filterfiles(droidrows):
+                pass
+            folders = droidcsvhandler.folders
+            sys.stderr.write("DROID rows read: %d, folders found: %d\n"
+                             % (droidcsvhandler.rowcount, len(folders)))
+            return folders
 
-    def createOverviewSheet(self):
+    def createOverviewSheet(self, outfile=None):
         if self.droidcsv != False:
             self.droidlist = self.readDROIDCSV()
-            self.outputOverview()
+            self.outputOverview(outfile)
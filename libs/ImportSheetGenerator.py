@@ -1,22 +1,77 @@
 # -*- coding: utf-8 -*-
 import sys
+import time
+import itertools
 import ConfigParser
-from datetime import datetime
+import multiprocessing
 from droidcsvhandlerclass import *
+from ImportSheetWriter import CSVSheetWriter, sheetwriters
+from MappingPlan import MappingPlan
+from PathMasker import PathMasker, configmasker
+from DateHandler import droidyearparser
+from PipelineStats import NoStats
+from WorkerPool import poolworkers
 
 # Table schema code...
 sys.path.append(r'JsonTableSchema/')
 import JsonTableSchema
 
+# The generator used by worker processes. It is set before the pool is
+# created so that, on fork, each worker inherits the config, compiled
+# mapping and external index without them being pickled.
+workergenerator = None
+
+
+def mapchunk(args):
+    rows, externalmapping = args
+    generator = workergenerator
+    writer = generator.writerclass(flushsize=sys.maxint,
+                                   columns=generator.loadschema().as_list())
+    # the match log is kept with the chunk, the parent writes it in order
+    external = generator.externalCSV
+    if external is not None and external.matchlog is not None:
+        external.setMatchLog(CSVSheetWriter(flushsize=sys.maxint))
+    if generator.columnar:
+        importrows = generator.mapcolumnar(rows, externalmapping)
+    else:
+        importrows = [generator.maprow(filerow, externalmapping)
+                      for filerow in rows]
+    writer.writerows(importrows)
+    # rows are checked here, only uniqueness is left to the parent
+    checked = None
+    if generator.validator is not None:
+        checked = generator.validator.checkchunk(importrows)
+    counts = None
+    if generator.externalCSV is not None:
+        counts = generator.externalCSV.takecounts()
+    return writer.getvalue(), writer.rowcount, counts, checked
+
 
 class ImportSheetGenerator:
 
+    hashcolumns = ['MD5_HASH', 'SHA1_HASH', 'SHA256_HASH']
+
     def __init__(self, droidcsv, importschema, configfile):
         self.externalCSV = None
+        self.previous = None
+        self.hasher = None
+        self.outfile = None
+        self.flushsize = None
+        self.writerclass = CSVSheetWriter
+        self.validator = None
+        self.schema = None
+        self.plans = {}
+        self.workers = 1
+        self.columnar = False
+        self.chunksize = 2000
+        self.yearparser = droidyearparser()
+        self.stats = NoStats()
         self.config = ConfigParser.RawConfigParser()
+        self.pathmasker = PathMasker()
         if configfile is not False and configfile is not None:
             self.config.read(configfile)
-            self.pathmask = self.config.get('additional values', 'pathmask')
+            self.pathmasker = configmasker(
+                self.config, 'additional values', 'pathmask')
         self.droidcsv = droidcsv
         self.importschema = importschema
 
@@ -26,177 +81,307 @@ class ImportSheetGenerator:
         else:
             self.externalCSV = None
 
+    def setWorkers(self, workers):
+        if workers is not None and workers > 1:
+            self.workers = poolworkers(workers)
+        else:
+            self.workers = 1
+
+    # File the import sheet is written to, stdout if not set, and the bytes
+    # held in memory between writes to it
+    def setOutfile(self, outfile, flushsize=None):
+        self.outfile = outfile
+        self.flushsize = flushsize
+
+    # Output format, one of ImportSheetWriter.sheetwriters
+    def setFormat(self, format):
+        self.writerclass = sheetwriters[format]
+
+    # A SheetValidator to check rows with as they are written
+    def setValidator(self, validator):
+        self.validator = validator
+
+    # Map blocks of rows column by column instead of row by row
+    def setColumnar(self, columnar):
+        self.columnar = columnar is True
+
+    # A PreviousRun whose sheet rows can be reused for unchanged files
+    def setPrevious(self, previous):
+        self.previous = previous
+
+    # A FileHasher to compute checksums missing from the DROID CSV
+    def setHasher(self, hasher):
+        self.hasher = hasher
+
+    def setStats(self, stats):
+        if stats is not None:
+            self.stats = stats
+
     def retrieve_year_from_modified_date(self, MODIFIED_DATE):
         year = ""
         if MODIFIED_DATE != '':
-            inputdateformat = '%Y-%m-%dT%H:%M:%S'
-            year = datetime.strptime(MODIFIED_DATE, inputdateformat).year
+            year = self.yearparser.year(MODIFIED_DATE)
         else:
             sys.stderr.write("Date field used to extrave 'year' is blank.")
         return year
 
-    def add_csv_value(self, value):
-        field = ''
-        if type(value) is int:  # TODO: probably a better way to do this (type-agnostic)
-            field = '"' + str(value) + '"'
-        else:
-            field = '"' + value.encode('utf-8') + '"'
-        return field
-
     def get_path(self, path):
-        return path.replace(self.pathmask, "")
+        return self.pathmasker.strip(path)
 
     def get_title(self, title):
         # split once at full-stop (assumptuon 'ext' follows)
         return title.rsplit('.', 1)[0].rstrip()
 
-    count = 0
-
-    def splitns(self, value):
-        return value.split(':', 1)[1]
-
     def get_external_row(self, checksum, path):
-        for row in self.externalCSV:
-            if row.path == path and row.checksum == checksum:
-                return row
-
-        if row.path != path:
-            sys.stderr.write("We didn't find something, path didn't match..." \
-               + row.path.encode(
-                'utf-8') + " " + path.encode('utf-8') + " " + \
-               checksum.encode('utf-8') + "\n")
-            return None
-
-        if row.checksum.upper() != checksum:
-            sys.stderr.write(
-                "We didn't find something, checksum didn't match... " + \
-                row.checksum + " " + row.checksum + "\n")
-            return None
+        return self.externalCSV.lookup(checksum, path)
 
     def maptoimportschema(self, externalmapping=False):
 
         if self.importschema != False:
-            f = open(self.importschema, 'rb')
-
-            importschemajson = f.read()
-
-            importschema = JsonTableSchema.JSONTableSchema(importschemajson)
-            importschemadict = importschema.as_dict()
-            importschemaheader = importschema.as_csv_header()
-
-            importcsv = importschemaheader + "\n"
-
-            for filerow in self.droidlist:
-
-                r = None
-
-                # First, retrieve a matching row from our external CSV...
-                if externalmapping is True:
-                    path = ""
-                    if 'FILE_PATH' in filerow:
-                        path = self.get_path(filerow['FILE_PATH'])
-                    if 'MD5_HASH' in filerow:
-                        hash = filerow['MD5_HASH'].upper()
-                    elif 'SHA1_HASH' in filerow:
-                        hash = filerow['SHA1_HASH'].upper()
-                    elif 'SHA256_HASH' in filerow:
-                        hash = filerow['SHA256_HASH'].upper()
-
-                    r = self.get_external_row(hash, path)
-
-                # Extract year from file modified date for open and closed year
-                yearopenclosed = self.retrieve_year_from_modified_date(
-                    filerow['LAST_MODIFIED'])
-
-                for column in importschemadict['fields']:
-                    fieldtext = ""
-                    entry = False
-
-                    if r is not None:
-                        for val in r.rdict:
-                            if column['name'] == r.rdict[val]:
-                                if column['name'] != 'Description':
-                                    val = self.splitns(val)
-                                fieldtext = val
-                                if column['name'] == 'Title':
-                                    fieldtext = self.get_title(fieldtext)
-                                importcsv = importcsv + \
-                                    self.add_csv_value(fieldtext)
-                                entry = True
-                                break
-
-                    if entry != True:
-                        if self.config.has_option('droid mapping', \
-                           column['name']):
-                            droidfield = self.config.get(
-                                'droid mapping', column['name'])
-                            if droidfield == 'FILE_PATH':
-                                dir = os.path.dirname(filerow['FILE_PATH'])
-                                fieldtext = self.get_path(dir)
-                            if droidfield == 'NAME':
-                                fieldtext = self.get_title(filerow['NAME'])
-                            if droidfield == 'MD5_HASH':
-                                fieldtext = filerow['MD5_HASH']
-                            if droidfield == 'SHA1_HASH':
-                                fieldtext = filerow['SHA1_HASH']
-                            if droidfield == 'SHA256_HASH':
-							    fieldtext = filerow['SHA256_HASH']
-                            if droidfield == 'LAST_MODIFIED':
-                                if self.config.has_option('additional values',\
-                                 'descriptiontext'):
-                                    fieldtext = self.config.get(
-                                    'additional values', 'descriptiontext') \
-                                    + " " + str(filerow[droidfield])
-
-                            importcsv = importcsv + \
-                                self.add_csv_value(fieldtext)
-                            entry = True
-
-                    if self.config.has_option('static values', column['name']):
-                        importcsv = importcsv + \
-                            self.add_csv_value(
-                                self.config.get('static values', \
-                                 column['name']))
-                        entry = True
-
-                    # If we haven't years from an external source, add them
-                    # here...
-                    if (column['name'] == 'Open Year') and entry != True:
-                        importcsv = importcsv + \
-                            self.add_csv_value(yearopenclosed)
-                        entry = True
-
-                    if (column['name'] == 'Close Year') and entry != True:
-                        importcsv = importcsv + \
-                            self.add_csv_value(yearopenclosed)
-                        entry = True
-
-                    if entry == False:
-                        importcsv = importcsv + self.add_csv_value("")
-
-                    importcsv = importcsv + ","
-
-                importcsv = importcsv.rstrip(',') + "\n"
-
-            f.close()
-
-            sys.stdout.write(importcsv)
-
+            importschema = self.loadschema()
+
+            # config parsing happens here, once, not for every row
+            self.plan = self.compilemapping(importschema.as_dict()['fields'])
+
+            # rows are written out as soon as they are mapped
+            writer = self.writerclass(self.outfile, self.flushsize)
+            writer.setValidator(self.validator)
+            writer.writeheader(importschema.as_list())
+
+            incremental = False
+            if self.previous is not None:
+                with self.stats.stage("previous load"):
+                    incremental = self.previous.load(
+                        self.droidcolumns(), importschema.as_list())
+
+            if incremental:
+                with self.stats.stage("map and serialise (incremental)"):
+                    self.mapincremental(writer, externalmapping)
+            elif self.workers > 1:
+                with self.stats.stage("map and serialise (workers)"):
+                    self.mapinworkers(writer, externalmapping)
+            elif self.columnar:
+                with self.stats.stage("map and serialise (columnar)"):
+                    for rows, externalmapping in self.chunkrows(
+                            externalmapping):
+                        writer.writerows(
+                            self.mapcolumnar(rows, externalmapping))
+            elif self.stats.enabled:
+                self.mapwithstats(writer, externalmapping)
+            else:
+                for filerow in self.droidlist:
+                    writer.writerow(self.maprow(filerow, externalmapping))
+
+            with self.stats.stage("write"):
+                writer.close()
+            self.droidcount = writer.rowcount
+            self.stats.setcount("bytes written", writer.byteswritten)
+            if self.externalCSV is not None:
+                self.stats.setcount("external exact hits",
+                                    self.externalCSV.exacthits)
+                self.stats.setcount("external checksum only hits",
+                                    self.externalCSV.checksumhits)
+                self.stats.setcount("external path only hits",
+                                    self.externalCSV.pathhits)
+                self.stats.setcount("external misses",
+                                    self.externalCSV.misscount)
+                self.stats.setcount("external ambiguous misses",
+                                    self.externalCSV.ambiguouscount)
+            if self.hasher is not None:
+                self.stats.setcount("files hashed", self.hasher.hashed)
+                self.stats.setcount("hashes from cache", self.hasher.cached)
+
+    # The same loop as maptoimportschema, timing each step per row
+    def mapwithstats(self, writer, externalmapping):
+        stats = self.stats
+        matchtime = maptime = writetime = 0.0
+        rows = 0
+        for filerow in self.droidlist:
+            rows += 1
+            start = time.time()
+            r = None
+            if externalmapping is True:
+                stats.startprofile("external match")
+                r = self.matchexternal(filerow)
+                stats.stopprofile("external match")
+            matched = time.time()
+            stats.startprofile("map")
+            importrow = self.mapmatched(filerow, r)
+            stats.stopprofile("map")
+            mapped = time.time()
+            stats.startprofile("write")
+            writer.writerow(importrow)
+            stats.stopprofile("write")
+            matchtime += matched - start
+            maptime += mapped - matched
+            writetime += time.time() - mapped
+        if externalmapping is True:
+            stats.addtime("external match", matchtime)
+            stats.addrows("external match", rows,
+                          rows - self.externalCSV.misscount)
+        stats.addtime("map", maptime)
+        stats.addrows("map", rows, rows)
+        stats.addtime("write", writetime)
+        stats.addrows("write", rows, rows)
+
+    # Reuse rows from the previous sheet where the DROID row is unchanged,
+    # only new and changed rows are mapped.
+    def mapincremental(self, writer, externalmapping):
+        previous = self.previous
+        rowkey = previous.rowkey(self.droidcsvhandler.index)
+        for filerow in self.droidlist:
+            importrow = previous.lookup(rowkey(filerow))
+            if importrow is None:
+                importrow = self.maprow(filerow, externalmapping)
+            elif externalmapping is True:
+                # so the match counts and log cover every row, as in a
+                # full run
+                self.matchexternal(filerow)
+            writer.writerow(importrow)
+        previous.reportcounts()
+        self.stats.setcount("previous rows reused", previous.reused)
+        self.stats.setcount("previous rows mapped", previous.remapped)
+
+    # Map chunks of DROID rows in a process pool. imap hands results back
+    # in the order the chunks were read, so output matches a single process.
+    def mapinworkers(self, writer, externalmapping):
+        global workergenerator
+        workergenerator = self
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            # chunks of whole blocks, so a format that packs rows into
+            # blocks writes the same bytes as a single process
+            blockrows = self.writerclass.blockrows
+            chunksize = max(1, self.chunksize // blockrows) * blockrows
+            for data, rowcount, counts, checked in pool.imap(
+                    mapchunk, self.chunkrows(externalmapping, chunksize)):
+                writer.writeraw(data, rowcount, checked)
+                if counts is not None:
+                    self.externalCSV.addcounts(counts)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            workergenerator = None
+
+    def chunkrows(self, externalmapping, chunksize=None):
+        if chunksize is None:
+            chunksize = self.chunksize
+        rows = iter(self.droidlist)
+        while True:
+            chunk = list(itertools.islice(rows, chunksize))
+            if not chunk:
+                break
+            yield chunk, externalmapping
+
+    # Read once, e.g. for all the accessions of a batch
+    def loadschema(self):
+        if self.schema is None:
+            self.schema = JsonTableSchema.load_schema(self.importschema)
+        return self.schema
+
+    # DROID columns this run reads, everything else is dropped on reading
+    def droidcolumns(self):
+        columns = ['FILE_PATH', 'LAST_MODIFIED'] + self.hashcolumns
+        if self.config.has_section('droid mapping'):
+            for name, droidfield in self.config.items('droid mapping'):
+                columns.append(droidfield)
+        return columns
+
+    # Needs the DROID CSV to be open so that column positions are known
+    def compilemapping(self, fields):
+        index = self.droidcsvhandler.index
+        self.pathcol = index.get('FILE_PATH')
+        self.modifiedcol = index.get('LAST_MODIFIED')
+        # the first checksum DROID reported is the one to match on
+        self.hashcol = None
+        for column in self.hashcolumns:
+            if column in index:
+                self.hashcol = index[column]
+                break
+        if self.hasher is not None:
+            self.hashcol = index[self.hasher.column]
+        # DROID CSVs with the same columns share a compiled plan
+        key = tuple(sorted(index.items()))
+        if key not in self.plans:
+            self.plans[key] = MappingPlan(self.config, fields, index,
+                                          self.get_path, self.get_title)
+            for column in sorted(self.plans[key].missing):
+                sys.stderr.write("DROID CSV " + str(self.droidcsv) +
+                                 " has no " + column + " column, values "
+                                 "mapped from it are left blank.\n")
+        return self.plans[key]
+
+    def maprow(self, filerow, externalmapping=False):
+        r = None
+        if externalmapping is True:
+            r = self.matchexternal(filerow)
+        return self.mapmatched(filerow, r)
+
+    # Map a block of DROID rows through the plan's columnar extractors
+    def mapcolumnar(self, rows, externalmapping=False):
+        if externalmapping is True:
+            externals = [self.matchexternal(filerow) for filerow in rows]
+        else:
+            externals = [None] * len(rows)
+        years = [""] * len(rows)
+        if self.plan.needsyear:
+            years = [self.retrieve_year_from_modified_date(
+                filerow[self.modifiedcol]) for filerow in rows]
+        return self.plan.mapcolumnar(rows, externals, years)
+
+    # Retrieve the matching row from our external CSV, if any...
+    def matchexternal(self, filerow):
+        path = ""
+        if self.pathcol is not None:
+            path = self.get_path(filerow[self.pathcol])
+        hash = ""
+        if self.hashcol is not None:
+            hash = filerow[self.hashcol].upper()
+
+        return self.get_external_row(hash, path)
+
+    def mapmatched(self, filerow, r):
+
+        # Extract year from file modified date for open and closed year
+        yearopenclosed = ""
+        if self.plan.needsyear:
+            yearopenclosed = self.retrieve_year_from_modified_date(
+                filerow[self.modifiedcol])
+
+        return self.plan.maprow(filerow, r, yearopenclosed)
+
+    # returns a generator, rows are filtered as they are read
     def readDROIDCSV(self):
         if self.droidcsv != False:
-            droidcsvhandler = droidCSVHandler()
-            droidlist = droidcsvhandler.readDROIDCSV(self.droidcsv)
-            droidlist = droidcsvhandler.removefolders(droidlist)
-            return droidcsvhandler.removecontainercontents(droidlist)
+            self.droidcsvhandler = droidCSVHandler()
+            read = self.stats.timed(
+                "read", self.droidcsvhandler.iterDROIDCSV(
+                    self.droidcsv, self.droidcolumns()))
+            rows = self.stats.timed(
+                "filter", self.droidcsvhandler.filterfiles(read), read)
+            if self.hasher is not None:
+                rows = self.stats.timed("hash", self.hasher.hashrows(
+                    rows, self.droidcsvhandler.index), rows)
+            return rows
 
     def droid2archwayimport(self):
         if self.externalCSV is not None and self.droidcsv != False and \
         self.importschema != False:
             self.droidlist = self.readDROIDCSV()
             self.maptoimportschema(True)
+            self.droidcsvhandler.reportcounts()
+            if self.hasher is not None:
+                self.hasher.reportcounts()
+            self.externalCSV.reportmatches()
             sys.stderr.write("External count: " + str(len(self.externalCSV))
                              + " DROID Count: " + \
-                             str(len(self.droidlist)) + "\n")
+                             str(self.droidcount) + "\n")
         elif self.droidcsv != False and self.importschema != False:
             self.droidlist = self.readDROIDCSV()
             self.maptoimportschema()
+            self.droidcsvhandler.reportcounts()
+            if self.hasher is not None:
+                self.hasher.reportcounts()
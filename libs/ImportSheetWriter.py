@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+import sys
+import csv
+import json
+import struct
+import unicodecsv
+from cStringIO import StringIO
+from json.encoder import encode_basestring_ascii
+
+
+# Rows are serialised into an in-memory buffer which is handed to the
+# output file in large writes. Subclasses decide how rows are serialised.
+# A writer made with columns but without writing a header, e.g. in a worker
+# process, serialises rows for another writer to add with writeraw.
+class SheetWriter:
+
+    # bytes held in memory before being handed to the output file
+    flushsize = 1 << 16
+
+    # rows serialised together, a format that packs rows into blocks sets
+    # this to the rows in a full block
+    blockrows = 1
+
+    def __init__(self, outfile=None, flushsize=None, columns=None):
+        if outfile is None:
+            outfile = sys.stdout
+        if flushsize is not None:
+            self.flushsize = flushsize
+        self.outfile = outfile
+        self.buffer = StringIO()
+        self.columns = columns
+        self.rowcount = 0
+        self.byteswritten = 0
+        self.validator = None
+
+    # A SheetValidator to check rows against the schema as they're written
+    def setValidator(self, validator):
+        self.validator = validator
+
+    def writeheader(self, header):
+        self.columns = header
+        self.__encodeheader__(header)
+        self.__checkflush__()
+
+    def writerow(self, row):
+        if self.validator is not None:
+            self.validator.validaterow(row)
+        self.__encoderow__(row)
+        self.rowcount += 1
+        self.__checkflush__()
+
+    def writerows(self, rows):
+        if self.validator is not None:
+            for row in rows:
+                self.validator.validaterow(row)
+        for row in rows:
+            self.__encoderow__(row)
+        self.rowcount += len(rows)
+        self.__checkflush__()
+
+    # Write rows already serialised by another writer of the same kind,
+    # e.g. in a worker process, keeping them in order with rows written
+    # here. checked is the validator's checkchunk result for the rows, if
+    # they were checked where they were mapped.
+    def writeraw(self, data, rowcount, checked=None):
+        if self.validator is not None:
+            if checked is not None:
+                self.validator.recordchecked(rowcount, *checked)
+            else:
+                for row in self.readrows(data):
+                    self.validator.validaterow(row)
+        self.flush()
+        self.outfile.write(data)
+        self.byteswritten += len(data)
+        self.rowcount += rowcount
+
+    def getvalue(self):
+        self.__pack__()
+        return self.buffer.getvalue()
+
+    # Drop rows held in memory, e.g. once they've been handed to another
+    # writer with getvalue.
+    def clear(self):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.rowcount = 0
+
+    def __checkflush__(self):
+        if self.buffer.tell() >= self.flushsize:
+            self.flush()
+
+    def flush(self):
+        self.__pack__()
+        data = self.buffer.getvalue()
+        if data != "":
+            self.outfile.write(data)
+            self.byteswritten += len(data)
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+    def close(self):
+        self.flush()
+        self.__finish__()
+        self.outfile.flush()
+
+    # Serialise rows held back for batching, before the buffer is read
+    def __pack__(self):
+        pass
+
+    # Anything the format needs after the last row
+    def __finish__(self):
+        pass
+
+
+def encodevalue(value):
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class CSVSheetWriter(SheetWriter):
+
+    def __init__(self, outfile=None, flushsize=None, columns=None):
+        SheetWriter.__init__(self, outfile, flushsize, columns)
+        # every value quoted, as Archway expects, with unix line endings
+        self.writer = unicodecsv.writer(self.buffer, quoting=csv.QUOTE_ALL,
+                                        lineterminator='\n')
+
+    def __encodeheader__(self, header):
+        self.writer.writerow(header)
+
+    def __encoderow__(self, row):
+        self.writer.writerow(row)
+
+    # writerows in one call, rather than a row at a time
+    def writerows(self, rows):
+        if self.validator is not None:
+            for row in rows:
+                self.validator.validaterow(row)
+        self.writer.writerows(rows)
+        self.rowcount += len(rows)
+        self.__checkflush__()
+
+    def readrows(self, data):
+        return csv.reader(StringIO(data))
+
+
+# One JSON object per line, keyed by import sheet column, in column order.
+# Every value is a string, as it would be in the CSV.
+class JSONLinesSheetWriter(SheetWriter):
+
+    def __init__(self, outfile=None, flushsize=None, columns=None):
+        SheetWriter.__init__(self, outfile, flushsize, columns)
+        self.keys = None
+
+    def __encodeheader__(self, header):
+        pass
+
+    def __encoderow__(self, row):
+        if self.keys is None:
+            self.keys = [encode_basestring_ascii(name) + ": "
+                         for name in self.columns]
+        fields = [key + encode_basestring_ascii(encodevalue(value))
+                  for key, value in zip(self.keys, row)]
+        self.buffer.write("{" + ", ".join(fields) + "}\n")
+
+    def readrows(self, data):
+        for line in StringIO(data):
+            values = json.loads(line)
+            yield [values[name] for name in self.columns]
+
+
+# A compact binary format that needs nothing but the standard library to
+# read. Integers are unsigned 32 bit little-endian. The file starts with
+# the magic bytes, then the number of columns and each column name, each
+# name as a length and its UTF-8 bytes. Rows follow in blocks, column by
+# column, so a reader can take whole columns: a block is its row and
+# column counts, then for each column the length of every value followed
+# by the values themselves. A block with no rows ends the file.
+class BinarySheetWriter(SheetWriter):
+
+    magic = "AISB\x01"
+
+    # rows held back to make up a block
+    blockrows = 4096
+
+    def __init__(self, outfile=None, flushsize=None, columns=None):
+        SheetWriter.__init__(self, outfile, flushsize, columns)
+        self.pending = []
+
+    def __encodeheader__(self, header):
+        self.buffer.write(self.magic)
+        self.buffer.write(struct.pack('<I', len(header)))
+        for name in header:
+            name = encodevalue(name)
+            self.buffer.write(struct.pack('<I', len(name)) + name)
+
+    def __encoderow__(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= self.blockrows:
+            self.__pack__()
+
+    def __pack__(self):
+        if not self.pending:
+            return
+        rows = self.pending
+        self.pending = []
+        columns = zip(*rows)
+        self.buffer.write(struct.pack('<II', len(rows), len(columns)))
+        for column in columns:
+            values = [encodevalue(value) for value in column]
+            self.buffer.write(struct.pack('<%dI' % len(values),
+                                          *[len(v) for v in values]))
+            self.buffer.write("".join(values))
+
+    def __finish__(self):
+        end = struct.pack('<II', 0, 0)
+        self.outfile.write(end)
+        self.byteswritten += len(end)
+
+    def readrows(self, data):
+        for columns in readblocks(StringIO(data)):
+            for row in zip(*columns):
+                yield row
+
+
+# Reading the binary format: readbinaryheader reads the column names from
+# the start of a file, readblocks then gives each block as a list of
+# columns, each a list of UTF-8 strings. Given the positions of the columns
+# wanted, readblocks skips over the others, and gives None in their place.
+def readbinaryheader(infile):
+    if infile.read(len(BinarySheetWriter.magic)) != BinarySheetWriter.magic:
+        raise ValueError("Not a binary import sheet")
+    count, = struct.unpack('<I', infile.read(4))
+    names = []
+    for i in range(count):
+        length, = struct.unpack('<I', infile.read(4))
+        names.append(infile.read(length).decode('utf-8'))
+    return names
+
+
+def readblocks(infile, wanted=None):
+    while True:
+        data = infile.read(8)
+        if len(data) < 8:
+            break
+        rowcount, columncount = struct.unpack('<II', data)
+        if rowcount == 0:
+            break
+        columns = []
+        for i in range(columncount):
+            lengths = struct.unpack('<%dI' % rowcount,
+                                    infile.read(4 * rowcount))
+            if wanted is not None and i not in wanted:
+                infile.seek(sum(lengths), 1)
+                columns.append(None)
+                continue
+            data = infile.read(sum(lengths))
+            values = []
+            offset = 0
+            for length in lengths:
+                values.append(data[offset:offset + length])
+                offset += length
+            columns.append(values)
+        yield columns
+
+
+# Output formats by the name given on the command line
+sheetwriters = {
+    "csv": CSVSheetWriter,
+    "jsonl": JSONLinesSheetWriter,
+    "binary": BinarySheetWriter,
+}
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import os.path
+
+
+# A MappingPlan is compiled once per run from the import mapping config and
+# the import schema. It holds one extractor per schema column, in schema
+# order, so mapping a DROID row never has to consult the config again.
+#
+# Every extractor is called as extractor(filerow, external, year) where
+# filerow is the DROID row tuple, external the matching external row or None
+# and year the year taken from the DROID modified date. DROID values are
+# read by position, using the reader's index of column name to position.
+#
+# Where a column could be filled from more than one source the precedence
+# is: external CSV, droid mapping, static values, then open/close year.
+#
+# Each column also has a columnar extractor which fills the column for a
+# whole block of rows at once, called as
+# extractor(droidcolumns, externals, years) with the DROID values by column
+# position, the external rows and the years as lists, one entry per row.
+# mapcolumnar gives the same rows as maprow.
+class MappingPlan:
+
+    droidmapping = 'droid mapping'
+    staticvalues = 'static values'
+    additionalvalues = 'additional values'
+    descriptiontext = 'descriptiontext'
+
+    yearcolumns = ['Open Year', 'Close Year']
+
+    # DROID columns an extractor reads values from
+    droidfields = ['FILE_PATH', 'NAME', 'MD5_HASH', 'SHA1_HASH',
+                   'SHA256_HASH', 'LAST_MODIFIED']
+
+    def __init__(self, config, fields, index, get_path, get_title):
+        self.config = config
+        self.index = index
+        self.get_path = get_path
+        self.get_title = get_title
+        self.columns = []
+        self.columnarextractors = []
+        self.needsyear = False
+        # mapped DROID columns the report doesn't have, left blank
+        self.missing = set()
+        self.__compile__(fields)
+
+    def __compile__(self, fields):
+        for i, column in enumerate(fields):
+            name = column['name']
+            extractor = self.__fallbackextractor__(name)
+            extractor = self.__externalextractor__(i, name, extractor)
+            self.columns.append((name, extractor))
+            columnar = self.__columnarfallback__(name)
+            columnar = self.__columnarexternal__(i, name, columnar)
+            self.columnarextractors.append((name, columnar))
+
+    # Values available without an external CSV...
+    def __fallbackextractor__(self, name):
+        if self.config.has_option(self.droidmapping, name):
+            droidfield = self.config.get(self.droidmapping, name)
+            return self.__droidextractor__(droidfield)
+        if self.config.has_option(self.staticvalues, name):
+            return self.__staticextractor__(
+                self.config.get(self.staticvalues, name))
+        if name in self.yearcolumns:
+            self.needsyear = True
+            return self.__yearextractor__()
+        return self.__staticextractor__("")
+
+    # True, and the column noted, if a mapped DROID column isn't in the
+    # report, e.g. MD5_HASH where DROID ran without hashing
+    def __missing__(self, droidfield):
+        if droidfield in self.droidfields and droidfield not in self.index:
+            self.missing.add(droidfield)
+            return True
+        return False
+
+    def __droidextractor__(self, droidfield):
+        if self.__missing__(droidfield):
+            return self.__staticextractor__("")
+        get_path = self.get_path
+        get_title = self.get_title
+        if droidfield == 'FILE_PATH':
+            column = self.index[droidfield]
+            def extract(filerow, external, year):
+                return get_path(os.path.dirname(filerow[column]))
+        elif droidfield == 'NAME':
+            column = self.index[droidfield]
+            def extract(filerow, external, year):
+                return get_title(filerow[column])
+        elif droidfield in ['MD5_HASH', 'SHA1_HASH', 'SHA256_HASH']:
+            column = self.index[droidfield]
+            def extract(filerow, external, year):
+                return filerow[column]
+        elif droidfield == 'LAST_MODIFIED' and self.config.has_option(
+                self.additionalvalues, self.descriptiontext):
+            column = self.index[droidfield]
+            text = self.config.get(
+                self.additionalvalues, self.descriptiontext) + " "
+            def extract(filerow, external, year):
+                return text + str(filerow[column])
+        else:
+            return self.__staticextractor__("")
+        return extract
+
+    def __staticextractor__(self, value):
+        def extract(filerow, external, year):
+            return value
+        return extract
+
+    def __yearextractor__(self):
+        def extract(filerow, external, year):
+            return year
+        return extract
+
+    # Values from the external CSV take precedence when a row matched. The
+    # external row holds its values by import column position.
+    def __externalextractor__(self, index, name, fallback):
+        get_title = self.get_title
+        title = name == 'Title'
+        def extract(filerow, external, year):
+            if external is not None:
+                value = external.values[index]
+                if value is not None:
+                    if title:
+                        value = get_title(value)
+                    return value
+            return fallback(filerow, external, year)
+        return extract
+
+    # Columnar extractors, column by column, mirroring those above...
+    def __columnarfallback__(self, name):
+        if self.config.has_option(self.droidmapping, name):
+            droidfield = self.config.get(self.droidmapping, name)
+            return self.__columnardroid__(droidfield)
+        if self.config.has_option(self.staticvalues, name):
+            return self.__columnarstatic__(
+                self.config.get(self.staticvalues, name))
+        if name in self.yearcolumns:
+            return self.__columnaryear__()
+        return self.__columnarstatic__("")
+
+    def __columnardroid__(self, droidfield):
+        if self.__missing__(droidfield):
+            return self.__columnarstatic__("")
+        get_path = self.get_path
+        get_title = self.get_title
+        if droidfield == 'FILE_PATH':
+            column = self.index[droidfield]
+            def extract(droidcolumns, externals, years):
+                # files in the same folder share a value, work it out once
+                folders = {}
+                values = []
+                for path in droidcolumns[column]:
+                    folder = os.path.dirname(path)
+                    value = folders.get(folder)
+                    if value is None:
+                        value = folders[folder] = get_path(folder)
+                    values.append(value)
+                return values
+        elif droidfield == 'NAME':
+            column = self.index[droidfield]
+            def extract(droidcolumns, externals, years):
+                return map(get_title, droidcolumns[column])
+        elif droidfield in ['MD5_HASH', 'SHA1_HASH', 'SHA256_HASH']:
+            column = self.index[droidfield]
+            def extract(droidcolumns, externals, years):
+                return list(droidcolumns[column])
+        elif droidfield == 'LAST_MODIFIED' and self.config.has_option(
+                self.additionalvalues, self.descriptiontext):
+            column = self.index[droidfield]
+            text = self.config.get(
+                self.additionalvalues, self.descriptiontext) + " "
+            def extract(droidcolumns, externals, years):
+                return [text + str(value) for value in droidcolumns[column]]
+        else:
+            return self.__columnarstatic__("")
+        return extract
+
+    def __columnarstatic__(self, value):
+        def extract(droidcolumns, externals, years):
+            return [value] * len(externals)
+        return extract
+
+    def __columnaryear__(self):
+        def extract(droidcolumns, externals, years):
+            return list(years)
+        return extract
+
+    # The fallback column is filled first and external values laid over it
+    def __columnarexternal__(self, index, name, fallback):
+        get_title = self.get_title
+        title = name == 'Title'
+        def extract(droidcolumns, externals, years):
+            values = fallback(droidcolumns, externals, years)
+            for row, external in enumerate(externals):
+                if external is not None:
+                    value = external.values[index]
+                    if value is not None:
+                        if title:
+                            value = get_title(value)
+                        values[row] = value
+            return values
+        return extract
+
+    def maprow(self, filerow, external=None, year=""):
+        return [extract(filerow, external, year)
+                for name, extract in self.columns]
+
+    # Map a block of rows column by column, returns the rows in order
+    def mapcolumnar(self, filerows, externals, years):
+        droidcolumns = zip(*filerows)
+        columns = [extract(droidcolumns, externals, years)
+                   for name, extract in self.columnarextractors]
+        return zip(*columns)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import gzip
+import tempfile
+
+
+# os.rename over an existing file, which Python 2 on Windows refuses; there
+# MoveFileEx replaces the file in one step instead.
+def replacefile(source, target):
+    if sys.platform != "win32":
+        os.rename(source, target)
+        return
+    import ctypes
+    replaceexisting = 0x1
+    writethrough = 0x8
+    if isinstance(source, str):
+        source = source.decode(sys.getfilesystemencoding())
+    if isinstance(target, str):
+        target = target.decode(sys.getfilesystemencoding())
+    if not ctypes.windll.kernel32.MoveFileExW(
+            source, target, replaceexisting | writethrough):
+        raise ctypes.WinError()
+
+
+# A file that only appears at its path once it has been written in full.
+# Output goes to a temporary file in the same directory, which is renamed
+# over the path on a clean exit and removed if anything goes wrong, so a
+# reader never sees half a sheet. Writes are buffered in large blocks and
+# may be gzip compressed. Without a path, output goes to stdout.
+#
+#   with OutputFile("sheet.csv") as outfile:
+#       outfile.write(...)
+class OutputFile:
+
+    buffersize = 1 << 20
+
+    def __init__(self, path, buffersize=None, compress=None):
+        self.path = path
+        if buffersize is not None:
+            self.buffersize = buffersize
+        if compress is None:
+            compress = path is not None and path.endswith(".gz")
+        self.compress = compress
+        self.rawfile = None
+        self.outfile = None
+
+    def __enter__(self):
+        if self.path is None:
+            self.temppath = None
+            self.rawfile = sys.stdout
+            self.outfile = self.rawfile
+            if self.compress:
+                self.outfile = gzip.GzipFile("", 'wb', 6, self.rawfile)
+            return self.outfile
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, self.temppath = tempfile.mkstemp(
+            dir=directory, prefix="." + os.path.basename(self.path) + ".",
+            suffix=".tmp")
+        self.rawfile = os.fdopen(fd, 'wb', self.buffersize)
+        self.outfile = self.rawfile
+        if self.compress:
+            # the name stored in the gzip header is the uncompressed one
+            name = os.path.basename(self.path)
+            if name.endswith(".gz"):
+                name = name[:-3]
+            self.outfile = gzip.GzipFile(name, 'wb', 6, self.rawfile)
+        return self.outfile
+
+    def __exit__(self, exctype, exc, tb):
+        try:
+            if self.outfile is not self.rawfile:
+                self.outfile.close()
+            self.rawfile.flush()
+            if self.temppath is None:
+                return False
+            if exctype is None:
+                os.fsync(self.rawfile.fileno())
+            self.rawfile.close()
+        except:
+            if self.temppath is not None:
+                os.remove(self.temppath)
+            raise
+        if exctype is not None:
+            os.remove(self.temppath)
+            return False
+        # mkstemp makes the file readable only by us, give it the
+        # permissions a file opened normally would have
+        try:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(self.temppath, 0666 & ~umask)
+            replacefile(self.temppath, self.path)
+        except:
+            os.remove(self.temppath)
+            raise
+        return False
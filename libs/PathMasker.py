@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+
+# Strips the leading part of a path that matches one of a set of masks,
+# e.g. the drive and share an accession was copied from. Masks only match
+# at the start of a path, '/' and '\' are treated alike, and where several
+# masks match the longest is removed. The rest of the path is left as is.
+#
+# Masks are held by length so a path is checked with one slice and set
+# lookup per distinct mask length, longest first, rather than a replace
+# per mask.
+class PathMasker:
+
+    def __init__(self, masks=None):
+        self.masks = {}
+        self.lengths = []
+        self.prefixes = set()
+        for mask in masks or []:
+            self.add(mask)
+
+    def add(self, mask):
+        if isinstance(mask, str):
+            mask = mask.decode('utf-8')
+        mask = self.normalise(mask)
+        if mask == "":
+            return
+        self.masks.setdefault(len(mask), set()).add(mask)
+        self.lengths = sorted(self.masks, reverse=True)
+        for i in range(len(mask) + 1):
+            self.prefixes.add(mask[:i])
+
+    @staticmethod
+    def normalise(path):
+        return path.replace('/', '\\')
+
+    def strip(self, path):
+        for length in self.lengths:
+            if self.normalise(path[:length]) in self.masks[length]:
+                return path[length:]
+        return path
+
+    # True if the path is a mask or leads to one, e.g. a folder above the
+    # accession in the DROID report.
+    def covers(self, path):
+        return self.normalise(path) in self.prefixes
+
+    def __len__(self):
+        return sum(len(masks) for masks in self.masks.values())
+
+
+# Masks from a config section: every option whose name starts with the
+# given name, e.g. pathmask, pathmask2, and every line of a value that
+# runs over several lines.
+def configmasks(config, section, name):
+    masks = []
+    if config.has_section(section):
+        for option, value in config.items(section):
+            if option.startswith(name.lower()):
+                masks.extend(line.strip() for line in value.splitlines())
+    return [mask for mask in masks if mask != ""]
+
+
+def configmasker(config, section, name):
+    return PathMasker(configmasks(config, section, name))
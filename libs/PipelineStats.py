@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import time
+import pstats
+import cProfile
+from StringIO import StringIO
+from collections import OrderedDict
+
+
+# Wall time per stage, rows in and out per stage and other counters for a
+# run of the generator. Enabled with --stats; when disabled a NoStats object
+# stands in and the per-row loops skip timing altogether.
+class PipelineStats:
+
+    enabled = True
+
+    def __init__(self, profilestage=None):
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.profilestage = profilestage
+        self.profiler = None
+        if profilestage is not None:
+            self.profiler = cProfile.Profile()
+
+    def __getstage__(self, name):
+        if name not in self.stages:
+            self.stages[name] = OrderedDict(
+                [("seconds", 0.0), ("rows_in", 0), ("rows_out", 0)])
+        return self.stages[name]
+
+    def addtime(self, name, seconds):
+        self.__getstage__(name)["seconds"] += seconds
+
+    def addrows(self, name, rowsin, rowsout):
+        stage = self.__getstage__(name)
+        stage["rows_in"] += rowsin
+        stage["rows_out"] += rowsout
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def setcount(self, name, value):
+        self.counters[name] = value
+
+    # Profiling is switched on only while the chosen stage is running
+    def startprofile(self, name):
+        if self.profiler is not None and name == self.profilestage:
+            self.profiler.enable()
+
+    def stopprofile(self, name):
+        if self.profiler is not None and name == self.profilestage:
+            self.profiler.disable()
+
+    # Time a block of code: with stats.stage("external load"): ...
+    def stage(self, name):
+        return TimedBlock(self, name)
+
+    # Wrap a generator stage. Time is recorded exclusive of the stage
+    # upstream of it, if that stage is also timed.
+    def timed(self, name, iterable, upstream=None):
+        return TimedIterator(self, name, iterable, upstream)
+
+    def asdict(self):
+        return OrderedDict([("stages", self.stages),
+                            ("counters", self.counters)])
+
+    def report(self, stream=sys.stderr):
+        for stage in self.stages.values():
+            stage["seconds"] = round(stage["seconds"], 4)
+        stream.write(json.dumps(self.asdict(), indent=2) + "\n")
+        if self.profiler is not None:
+            out = StringIO()
+            profile = pstats.Stats(self.profiler, stream=out)
+            profile.sort_stats('cumulative').print_stats(25)
+            stream.write("Profile of stage '" + self.profilestage + "':\n")
+            stream.write(out.getvalue())
+
+
+class TimedBlock:
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.startprofile(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.addtime(self.name, time.time() - self.start)
+        self.stats.stopprofile(self.name)
+        return False
+
+
+class TimedIterator:
+
+    def __init__(self, stats, name, iterable, upstream=None):
+        self.stats = stats
+        self.name = name
+        self.iterable = iter(iterable)
+        self.upstream = upstream
+        self.seconds = 0.0
+        self.rowsout = 0
+        self.recorded = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self.stats.startprofile(self.name)
+        start = time.time()
+        try:
+            row = self.iterable.next()
+        except StopIteration:
+            self.__record__(start)
+            raise
+        finally:
+            self.stats.stopprofile(self.name)
+        self.seconds += time.time() - start
+        self.rowsout += 1
+        return row
+
+    def __record__(self, start):
+        self.seconds += time.time() - start
+        # an exhausted stage may be asked for more rows, count it once
+        if self.recorded:
+            return
+        self.recorded = True
+        seconds = self.seconds
+        rowsin = self.rowsout
+        if self.upstream is not None:
+            seconds -= self.upstream.seconds
+            rowsin = self.upstream.rowsout
+        self.stats.addtime(self.name, seconds)
+        self.stats.addrows(self.name, rowsin, self.rowsout)
+
+
+# Stand-in used when --stats is off, so coarse stages can always be wrapped
+# in 'with stats.stage(...)' without checking whether stats are enabled.
+class NoStats:
+
+    enabled = False
+
+    def stage(self, name):
+        return NoBlock()
+
+    def timed(self, name, iterable, upstream=None):
+        return iterable
+
+    def addtime(self, name, seconds):
+        pass
+
+    def addrows(self, name, rowsin, rowsout):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def setcount(self, name, value):
+        pass
+
+
+class NoBlock:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
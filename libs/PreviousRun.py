@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import sys
+import csv
+import gzip
+import json
+import hashlib
+from itertools import izip_longest
+from collections import OrderedDict
+from droidcsvhandlerclass import *
+from OutputFile import OutputFile
+
+# A record of what a sheet was made from is written alongside it, in
+# sheet + runsuffix, so a later run can tell whether its rows still hold
+runsuffix = ".run.json"
+
+readsize = 1 << 20
+
+
+def filedigest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(readsize)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+# The inputs, other than the DROID CSV, that decide a sheet's rows. hash is
+# the algorithm checksums missing from the DROID CSV were computed with,
+# "auto" for the report's own, or None if they weren't.
+def runrecord(configfile, importschema, externalcsv=None, format="csv",
+              hash=None):
+    external = None
+    if externalcsv:
+        external = filedigest(externalcsv)
+    return OrderedDict([("config", filedigest(configfile)),
+                        ("schema", filedigest(importschema)),
+                        ("external", external),
+                        ("format", format),
+                        ("hash", hash)])
+
+
+def writerunrecord(sheet, record):
+    with OutputFile(sheet + runsuffix, compress=False) as f:
+        json.dump(record, f, indent=2)
+
+
+def opensheet(sheet):
+    if sheet.endswith(".gz"):
+        return gzip.open(sheet, 'rb')
+    return open(sheet, 'rb')
+
+
+# The DROID CSV and import sheet from an earlier run, for regenerating a
+# sheet after an accession has been re-profiled. Each file row of the old
+# DROID CSV is paired with the sheet row written for it, keyed on every
+# DROID column the mapping reads, so a row is only reused when the new
+# DROID CSV has the same values for all of them. Rows that are new or have
+# changed are mapped as normal.
+#
+# The earlier sheet is only used if the record written alongside it shows
+# it was made, as CSV, from the same config, schema and external CSV, and
+# with checksums computed the same way, as this run, given as record.
+class PreviousRun:
+
+    def __init__(self, droidcsv, sheet, record=None):
+        self.droidcsv = droidcsv
+        self.sheet = sheet
+        self.record = record
+        self.rows = {}
+        self.keycolumns = []
+        self.reused = 0
+        self.remapped = 0
+
+    # Returns False if the earlier sheet can't be used, the caller then
+    # maps every row.
+    def load(self, columns, header):
+        if not self.__samerun__():
+            return False
+        self.keycolumns = sorted(set(columns))
+        handler = droidCSVHandler()
+        droidrows = handler.filterfiles(
+            handler.iterDROIDCSV(self.droidcsv, self.keycolumns))
+        rowkey = self.rowkey(handler.index)
+        with opensheet(self.sheet) as sheetfile:
+            reader = csv.reader(sheetfile)
+            sheetheader = [h.decode('utf-8') for h in next(reader, [])]
+            if sheetheader != [unicode(h) for h in header]:
+                sys.stderr.write("Previous import sheet has different "
+                                 "columns, mapping all rows.\n")
+                return False
+            for filerow, sheetrow in izip_longest(droidrows, reader):
+                if filerow is None or sheetrow is None:
+                    sys.stderr.write("Previous import sheet does not match "
+                                     "previous DROID CSV, mapping all rows.\n")
+                    self.rows = {}
+                    return False
+                self.rows[rowkey(filerow)] = sheetrow
+        return True
+
+    def __samerun__(self):
+        try:
+            with open(self.sheet + runsuffix, 'rb') as f:
+                previous = json.load(f)
+        except (IOError, ValueError):
+            sys.stderr.write("Previous import sheet has no record of the run "
+                             "that made it, mapping all rows.\n")
+            return False
+        if previous.get("format") != "csv":
+            sys.stderr.write("Previous import sheet is not a CSV, mapping "
+                             "all rows.\n")
+            return False
+        if previous != json.loads(json.dumps(self.record)):
+            sys.stderr.write("Previous import sheet was made with a different "
+                             "config, schema, external CSV or --hash-files, "
+                             "mapping all rows.\n")
+            return False
+        return True
+
+    # A function giving the key of a row read with the given column index
+    def rowkey(self, index):
+        positions = [index.get(column) for column in self.keycolumns]
+        def key(filerow):
+            return tuple([filerow[p] if p is not None else None
+                          for p in positions])
+        return key
+
+    # The earlier sheet row, or None if the row has to be mapped
+    def lookup(self, key):
+        sheetrow = self.rows.get(key)
+        if sheetrow is None:
+            self.remapped += 1
+        else:
+            self.reused += 1
+        return sheetrow
+
+    def reportcounts(self):
+        sys.stderr.write("Rows reused from previous sheet: " +
+                         str(self.reused) + " Rows mapped: " +
+                         str(self.remapped) + "\n")
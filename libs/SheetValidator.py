@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+import re
+import sys
+import csv
+import itertools
+from cStringIO import StringIO
+import multiprocessing
+from WorkerPool import poolworkers
+from collections import OrderedDict
+
+# Table schema code...
+sys.path.append(r'JsonTableSchema/')
+import JsonTableSchema
+import csvdatatypes
+
+# The validator used by worker processes, set before the pool is created,
+# as with ImportSheetGenerator.workergenerator.
+workervalidator = None
+
+
+def checkchunk(args):
+    firstrow, data = args
+    return workervalidator.checkrows(firstrow, data)
+
+
+# Type names in csvdatatypes, by the first name of their category
+typenames = dict((name, category[0])
+                 for category in csvdatatypes.__valid_type_names__
+                 for name in category)
+
+# Patterns for the types we can check in a CSV, types not listed here,
+# e.g. string or any, accept every value.
+typepatterns = {
+    "integer": r"[+-]?\d+",
+    "date": r"\d{4}-\d{2}-\d{2}",
+    "time": r"\d{2}:\d{2}:\d{2}(\.\d+)?",
+    "date-time": r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?"
+                 r"(Z|[+-]\d{2}:?\d{2})?",
+    "boolean": r"(?i)(1|0|true|false)",
+}
+
+
+def isnumber(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def fullmatch(pattern):
+    return re.compile(r"(?:" + pattern + r")\Z", re.UNICODE).match
+
+
+# Checks rows of an import sheet against the types and constraints of a
+# JSON Table Schema. The checks for each column are compiled once; rows
+# are then checked one at a time as they are written, or an existing sheet
+# is checked in a pool of processes. Row numbers count the header as row 1,
+# as a spreadsheet would.
+class SheetValidator:
+
+    # violations written out in full, the rest are only counted
+    maxreported = 100
+
+    def __init__(self, schema):
+        self.names = schema.field_names
+        self.checks = []
+        self.unique = []
+        for field in schema.fields:
+            self.checks.append(self.__compilefield__(field))
+            constraints = field.get("constraints", {})
+            if constraints.get("unique"):
+                self.unique.append((self.names.index(field["name"]), set()))
+        self.rownumber = 1
+        self.violations = 0
+        self.counts = OrderedDict()
+        self.reported = []
+
+    # Returns (required, [(description, check)]) for a field, where check
+    # is given a non-empty value and returns False if it is invalid.
+    def __compilefield__(self, field):
+        checks = []
+        fieldtype = field.get("type")
+        category = typenames.get(fieldtype)
+        if category == "number":
+            checks.append(("type " + category, isnumber))
+        elif category in typepatterns:
+            pattern = typepatterns[category]
+            if fieldtype.endswith("#nonNegativeInteger"):
+                pattern = r"\+?\d+"
+            checks.append(("type " + category, fullmatch(pattern)))
+        constraints = field.get("constraints", {})
+        if "pattern" in constraints:
+            match = fullmatch(constraints["pattern"])
+            checks.append(("pattern", match))
+        if "minLength" in constraints:
+            minlength = int(constraints["minLength"])
+            checks.append(("minLength",
+                           lambda value: len(value) >= minlength))
+        if "maxLength" in constraints:
+            maxlength = int(constraints["maxLength"])
+            checks.append(("maxLength",
+                           lambda value: len(value) <= maxlength))
+        if "minimum" in constraints:
+            minimum = float(constraints["minimum"])
+            checks.append(("minimum",
+                           lambda value: isnumber(value) and
+                           float(value) >= minimum))
+        if "maximum" in constraints:
+            maximum = float(constraints["maximum"])
+            checks.append(("maximum",
+                           lambda value: isnumber(value) and
+                           float(value) <= maximum))
+        return constraints.get("required") is True, checks
+
+    # Everything but uniqueness, which needs every row, so this can run in
+    # a worker process. Returns a list of (row, column, check, value).
+    def checkrow(self, row, rownumber):
+        violations = []
+        if len(row) != len(self.names):
+            violations.append((rownumber, "", "column count", len(row)))
+            return violations
+        for name, (required, checks), value in itertools.izip(
+                self.names, self.checks, row):
+            if not required and not checks:
+                continue
+            value = self.__text__(value)
+            if value == "":
+                if required:
+                    violations.append((rownumber, name, "required", value))
+                continue
+            for description, check in checks:
+                if not check(value):
+                    violations.append((rownumber, name, description, value))
+        return violations
+
+    def checkunique(self, row, rownumber):
+        return self.__checkvalues__(self.uniquevalues(row), rownumber)
+
+    # The values of a row's unique columns, None where the row is short
+    def uniquevalues(self, row):
+        return [row[column] if column < len(row) else None
+                for column, seen in self.unique]
+
+    def __checkvalues__(self, values, rownumber):
+        violations = []
+        for (column, seen), value in itertools.izip(self.unique, values):
+            value = self.__text__(value)
+            if value == "":
+                continue
+            if value in seen:
+                violations.append((rownumber, self.names[column], "unique",
+                                   value))
+            else:
+                seen.add(value)
+        return violations
+
+    def __text__(self, value):
+        if value is None:
+            return u""
+        if isinstance(value, str):
+            return value.decode('utf-8')
+        if not isinstance(value, unicode):
+            return unicode(value)
+        return value
+
+    # Check a block of CSV text, the rows of a sheet from firstrow on
+    def checkrows(self, firstrow, data):
+        violations = []
+        reader = csv.reader(StringIO(data))
+        for rownumber, row in enumerate(reader, firstrow):
+            violations.extend(self.checkrow(row, rownumber))
+        return violations
+
+    # Check rows mapped in a worker process. Returns the checkrow
+    # violations, numbered from 1 within the rows, and the values needing
+    # a uniqueness check, for recordchecked in the parent.
+    def checkchunk(self, rows):
+        violations = []
+        for rownumber, row in enumerate(rows, 1):
+            violations.extend(self.checkrow(row, rownumber))
+        uniques = None
+        if self.unique:
+            uniques = [self.uniquevalues(row) for row in rows]
+        return violations, uniques
+
+    # Record the result of checkchunk for the next rowcount rows written
+    def recordchecked(self, rowcount, violations, uniques):
+        first = self.rownumber
+        self.record([(first + v[0],) + v[1:] for v in violations])
+        if uniques is not None:
+            for rownumber, values in enumerate(uniques, first + 1):
+                self.record(self.__checkvalues__(values, rownumber))
+        self.rownumber += rowcount
+
+    # Check the next row written to the sheet
+    def validaterow(self, row):
+        self.rownumber += 1
+        self.record(self.checkrow(row, self.rownumber))
+        if self.unique:
+            self.record(self.checkunique(row, self.rownumber))
+
+    def record(self, violations):
+        for violation in violations:
+            self.violations += 1
+            key = (violation[1], violation[2])
+            self.counts[key] = self.counts.get(key, 0) + 1
+            if len(self.reported) < self.maxreported:
+                self.reported.append(violation)
+
+    # Check an existing sheet, in a pool of processes if workers > 1.
+    # Returns the number of violations found.
+    def validatesheet(self, sheet, workers=1, chunksize=5000):
+        global workervalidator
+        with open(sheet, 'rb') as sheetfile:
+            header = self.__records__(sheetfile, 1)
+            header = [h.decode('utf-8') for h in
+                      next(csv.reader(StringIO("".join(header))), [])]
+            if header != [unicode(name) for name in self.names]:
+                self.record([(1, "", "header", u",".join(header))])
+                return self.violations
+            self.pending = []
+            chunks = self.__chunks__(sheetfile, chunksize)
+            if poolworkers(workers) > 1:
+                workervalidator = self
+                pool = multiprocessing.Pool(workers)
+                try:
+                    for violations in pool.imap(checkchunk, chunks):
+                        self.record(self.pending.pop(0))
+                        self.record(violations)
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+                    workervalidator = None
+            else:
+                for firstrow, data in chunks:
+                    self.record(self.pending.pop(0))
+                    self.record(self.checkrows(firstrow, data))
+        return self.violations
+
+    # Lines of the next count records. A quoted value may run over several
+    # lines; a record is complete once its quotes are balanced.
+    def __records__(self, sheetfile, count):
+        lines = []
+        quotes = 0
+        while count > 0:
+            line = sheetfile.readline()
+            if line == "":
+                break
+            lines.append(line)
+            quotes += line.count('"')
+            if quotes % 2 == 0:
+                count -= 1
+                quotes = 0
+        return lines
+
+    # Chunks are handed to workers as CSV text, which is cheaper to pass
+    # between processes than parsed rows. Uniqueness is checked here, as
+    # chunks are read, the rest by the caller. With a pool this runs in
+    # the pool's task thread, so the violations are queued on pending for
+    # the main thread to record with the chunk.
+    def __chunks__(self, sheetfile, chunksize):
+        while True:
+            data = "".join(self.__records__(sheetfile, chunksize))
+            if data == "":
+                break
+            firstrow = self.rownumber + 1
+            violations = []
+            rowcount = 0
+            for row in csv.reader(StringIO(data)):
+                rowcount += 1
+                if self.unique:
+                    violations.extend(
+                        self.checkunique(row, firstrow + rowcount - 1))
+            self.rownumber += rowcount
+            self.pending.append(violations)
+            yield firstrow, data
+
+    def report(self, stream=sys.stderr):
+        for rownumber, column, check, value in self.reported:
+            stream.write((u"Row %d, %s: %s (%s)\n" % (
+                rownumber, column or u"-", check,
+                self.__text__(value))).encode('utf-8'))
+        if self.violations > len(self.reported):
+            stream.write("... %d more\n"
+                         % (self.violations - len(self.reported)))
+        for (column, check), count in self.counts.items():
+            stream.write((u"%s %s: %d\n" % (column or u"-", check,
+                                              count)).encode('utf-8'))
+        stream.write("Rows validated: %d, schema violations: %d\n"
+                     % (self.rownumber - 1, self.violations))
+
+
+def schemavalidator(importschema):
+    return SheetValidator(JsonTableSchema.load_schema(importschema))
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import sys
+
+# Pools of worker processes are handed their state, the config, compiled
+# mapping and external index, through module globals set before the pool
+# is created, which the workers inherit when they are forked. Without fork,
+# e.g. on Windows, workers start from a fresh import without that state, so
+# the work is done in one process instead.
+canfork = sys.platform != "win32"
+
+
+# The number of worker processes to use when asked for workers
+def poolworkers(workers):
+    if workers > 1 and not canfork:
+        sys.stderr.write("Worker processes need fork, which this platform "
+                         "doesn't have, using one process.\n")
+        return 1
+    return workers
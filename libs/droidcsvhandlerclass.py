@@ -1,7 +1,8 @@
 ﻿# -*- coding: utf-8 -*-
+import sys
+import csv
 import unicodecsv
 import os.path
-from urlparse import urlparse
 
 
 class genericCSVHandler():
@@ -12,67 +13,158 @@ class genericCSVHandler():
             header_list.append(header)
         return header_list
 
+    # yields rows one at a time, each row is a dictionary
+    # header: value, pair.
+    def csviter(self, csvfname):
+        columncount = 0
+        with open(csvfname, 'rb') as csvfile:
+            csvreader = unicodecsv.reader(csvfile)
+            for row in csvreader:
+                if csvreader.line_num == 1:		# not zero-based index
+                    header_list = self.__getCSVheaders__(row)
+                    columncount = len(header_list)
+                else:
+                    csv_dict = {}
+                    # for each column in header
+                    # note: don't need ID data. Ignoring multiple ID.
+                    for i in range(columncount):
+                        csv_dict[header_list[i]] = row[i]
+                    yield csv_dict
+
     # returns list of rows, each row is a dictionary
     # header: value, pair.
     def csvaslist(self, csvfname):
-        columncount = 0
         csvlist = None
         if os.path.isfile(csvfname):
-            csvlist = []
-            with open(csvfname, 'rb') as csvfile:
-                csvreader = unicodecsv.reader(csvfile)
-                for row in csvreader:
-                    if csvreader.line_num == 1:		# not zero-based index
-                        header_list = self.__getCSVheaders__(row)
-                        columncount = len(header_list)
-                    else:
-                        csv_dict = {}
-                        # for each column in header
-                        # note: don't need ID data. Ignoring multiple ID.
-                        for i in range(columncount):
-                            csv_dict[header_list[i]] = row[i]
-                        csvlist.append(csv_dict)
+            csvlist = list(self.csviter(csvfname))
         return csvlist
 
 
+class CSVRowReader():
+
+    # file reads are made in chunks of this many bytes
+    buffersize = 1 << 20
+
+    # Reads a CSV as tuples holding only the requested columns, in header
+    # order. The header is read straight away so that index, the shared
+    # map of column name to tuple position, is ready before any row is.
+    #
+    # Rows are split by the C csv module over a large read buffer and only
+    # the cells that are kept are decoded, rather than every cell as
+    # unicodecsv does. Quoted fields spanning lines are handled by csv.
+    def __init__(self, csvfname, columns=None):
+        self.csvfile = open(csvfname, 'rb', self.buffersize)
+        self.csvreader = csv.reader(self.csvfile)
+        try:
+            self.header = self.__decode__(self.csvreader.next())
+        except StopIteration:
+            self.header = []
+        if columns is None:
+            self.positions = range(len(self.header))
+        else:
+            self.positions = [i for i, name in enumerate(self.header)
+                              if name in columns]
+        self.index = dict((self.header[p], i)
+                          for i, p in enumerate(self.positions))
+
+    def __iter__(self):
+        positions = self.positions
+        try:
+            for row in self.csvreader:
+                try:
+                    yield tuple([row[p].decode('utf-8') for p in positions])
+                except UnicodeDecodeError:
+                    # attempt a different encoding, as unicodecsv does...
+                    yield tuple([row[p].decode('ISO-8859-1')
+                                 for p in positions])
+        finally:
+            self.csvfile.close()
+
+    def __decode__(self, row):
+        try:
+            return [value.decode('utf-8') for value in row]
+        except UnicodeDecodeError:
+            return [value.decode('ISO-8859-1') for value in row]
+
+
 class droidCSVHandler():
 
-    # returns droidlist type
+    # DROID columns needed to filter rows and build the overview
+    filtercolumns = ['TYPE', 'URI', 'FILE_PATH']
 
-    def readDROIDCSV(self, droidcsvfname):
-        csvhandler = genericCSVHandler()
-        self.csv = csvhandler.csvaslist(droidcsvfname)
+    def __init__(self):
+        # counts gathered as rows pass through the filter stages
+        self.rowcount = 0
+        self.foldercount = 0
+        self.containercount = 0
+        # unique folder paths, in DROID order, collected by filterfiles
+        self.folders = []
+        self.__seenfolders__ = set()
+        # column name: position in each row tuple, set when a CSV is opened
+        self.index = {}
+
+    # returns droidlist type, a list of row tuples
+
+    def readDROIDCSV(self, droidcsvfname, columns=None):
+        self.csv = list(self.iterDROIDCSV(droidcsvfname, columns))
         return self.csv
 
-    def removecontainercontents(self, droidlist):
-        newlist = []   # naive remove causes loop to skip items
-        for row in droidlist:
-            uris = self.getURIScheme(row['URI'])
-            if self.getURIScheme(row['URI']) == 'file':
-                newlist.append(row)
-        return newlist
+    # returns a generator over the DROID rows, nothing is held in memory.
+    # columns limits the row tuples to the columns named, see index.
+    def iterDROIDCSV(self, droidcsvfname, columns=None):
+        if os.path.isfile(droidcsvfname):
+            if columns is not None:
+                columns = set(columns) | set(self.filtercolumns)
+            reader = CSVRowReader(droidcsvfname, columns)
+            self.index = reader.index
+            return self.__countrows__(reader)
+        return iter([])
 
-    def removefolders(self, droidlist):
-        # TODO: We can generate counts here and store in member vars
-        newlist = []   # naive remove causes loop to skip items
-        for i, row in enumerate(droidlist):
-            if row['TYPE'] != 'Folder':
-                newlist.append(row)
-        return newlist
+    def __countrows__(self, rows):
+        for row in rows:
+            self.rowcount += 1
+            yield row
 
-    def retrievefolderlist(self, droidlist):
-        newlist = []
-        for row in droidlist:
-            if row['TYPE'] == 'Folder':
-                newlist.append(row['FILE_PATH'])
-        return newlist
+    # Single pass: yields the files DROID found on disk, dropping folders
+    # and the contents of containers, and collects the folder paths for an
+    # overview sheet along the way.
+    def filterfiles(self, droidrows):
+        folders = self.folders
+        seen = self.__seenfolders__
+        isfileuri = self.isfileuri
+        if not self.index:      # no DROID CSV, or an empty one
+            return
+        typecol = self.index['TYPE']
+        uricol = self.index['URI']
+        pathcol = self.index['FILE_PATH']
+        for row in droidrows:
+            if row[typecol] == 'Folder':
+                self.foldercount += 1
+                folder = row[pathcol]
+                if folder not in seen:
+                    seen.add(folder)
+                    folders.append(folder)
+            elif isfileuri(row[uricol]):
+                yield row
+            else:
+                self.containercount += 1
 
     def retrievefoldernames(self, droidlist):
+        typecol = self.index['TYPE']
+        namecol = self.index['NAME']
         newlist = []
         for row in droidlist:
-            if row['TYPE'] == 'Folder':
-                newlist.append(row['NAME'])
+            if row[typecol] == 'Folder':
+                newlist.append(row[namecol])
         return newlist
 
-    def getURIScheme(self, url):
-        return urlparse(url).scheme
+    def reportcounts(self):
+        sys.stderr.write(
+            "DROID rows read: %d, folders removed: %d, container contents "
+            "removed: %d\n" % (self.rowcount, self.foldercount,
+                                self.containercount))
+
+    # True if the URI's scheme is file, without parsing the URI; container
+    # contents have URIs such as zip:file:/...
+    def isfileuri(self, url):
+        return url[:5].lower() == 'file:'